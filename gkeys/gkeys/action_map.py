@@ -21,7 +21,7 @@ Key_Actions = ['----keys-----', 'check-key', 'installed',
     'install-key', 'list-key', 'refresh-key', 'remove-key',
     'search-key', 'spec-check']
 
-General_Actions = ['---general---', 'list-cats', 'sign','verify']
+General_Actions = ['---general---', 'list-cats', 'migrate', 'sign','verify']
 
 Available_Actions = General_Actions + Key_Actions + Seed_Actions
 
@@ -44,6 +44,22 @@ Action_Map = OrderedDict([
  Gkey task results:
     Categories defined: gentoo-devs,  gentoo,  sign
 
+''',
+        }),
+    ('migrate', {
+        'func': 'migrate',
+        'options': ['category'],
+        'desc': '''Upgrade the seed files and installed keys to the current format''',
+        'long_desc': '''Upgrade the seed files and installed keys to the current format.
+    Rewrites all of the configured seed files and the gkey.seeds files of the
+    installed keys (or only those of the category given) which are still in
+    an older seed file format.  Current format files are loaded without
+    checking each of their entries for missing fields.''',
+        'example': '''$ gkeys migrate
+
+ Gkey task results:
+    Migrated 3 of 42 seed files to version 2
+
 ''',
         }),
     ('sign', {
@@ -360,7 +376,9 @@ Found Failures:
         'options': ['category', 'nick', '1file', 'dest', 'signature',
             'timestamp'],
         'desc': '''Download the selected seed file(s)''',
-        'long_desc': '''Download the selected seed file(s)''',
+        'long_desc': '''Download the selected seed file(s).  Without a category
+    all of the seed files with a configured url are downloaded concurrently,
+    each one is then verified in turn.''',
         'example': '''$ gkeys fetch-seed -C gentoo-devs
 
  Gkey task results:
@@ -14,6 +14,7 @@ from __future__ import print_function
 
 import os
 import sys
+import threading
 
 if sys.version_info[0] >= 3:
     _unicode = str
@@ -25,6 +26,8 @@ from snakeoil.demandload import demandload
 
 demandload(
     "json:load",
+    "multiprocessing.pool:ThreadPool",
+    "gkeys.fetcher:Fetcher,validators_path",
     "gkeys.lib:GkeysGPG",
     "gkeys.keyhandler:KeyHandler",
 )
@@ -42,7 +45,10 @@ class ActionBase(object):
         self._seedhandler = None
         self._keyhandler = None
         self._gpg = None
+        self._fetcher = None
         self.category = None
+        # gpg --trust-model of the category
+        self.trust = None
 
 
     @property
@@ -51,11 +57,22 @@ class ActionBase(object):
         if not self._gpg:
             self._gpg = GkeysGPG(self.config,
                 self._set_category(self.category), self.logger)
+            self._gpg.set_trust(self.trust)
         else:
             self._gpg.basedir = self._set_category(self.category)
         return self._gpg
 
 
+    @property
+    def fetcher(self):
+        '''Holds the classwide Fetcher instance, sharing its
+        connections between all the downloads'''
+        if not self._fetcher:
+            self._fetcher = Fetcher(self.logger,
+                validators_path(self.config.get_key('seedsdir')))
+        return self._fetcher
+
+
     @property
     def keyhandler(self):
         '''Holds the classwide KeyHandler instance'''
@@ -95,8 +112,60 @@ class ActionBase(object):
         trust = self.config.get_key('trust-model', cat)
         if trust in [None]:
             trust = 'auto'
-        if '--trust-model' in self.config.defaults['gpg_defaults']:
-            index = self.config.defaults['gpg_defaults'].index('--trust-model')
-            self.config.defaults['gpg_defaults'][index+1] = trust
-        else:
-            self.config.defaults['gpg_defaults'].extend(['--trust-model', trust])
+        self.trust = trust
+        if self._gpg:
+            self._gpg.set_trust(trust)
+
+
+    def _workers(self, key):
+        '''Returns the number of worker threads set by a config key'''
+        try:
+            return max(1, int(self.config.get_key(key) or 1))
+        except (TypeError, ValueError):
+            self.logger.warning("ACTIONS: _workers; invalid %s setting: %s"
+                % (key, self.config.get_key(key)))
+            return 1
+
+
+    def _thread_gpg(self):
+        '''Returns a function giving each thread its own GkeysGPG instance
+
+        The calling thread keeps using self.gpg, the others get a fork of it.
+        '''
+        gpg = self.gpg
+        owner = threading.current_thread()
+        local = threading.local()
+
+        def get():
+            if threading.current_thread() is owner:
+                return gpg
+            if not hasattr(local, 'gpg'):
+                local.gpg = gpg.fork()
+            return local.gpg
+
+        return get
+
+
+    def _map_gpg(self, func, gkeys, workers=1):
+        '''Runs func(gpg, gkey) for each of the gkeys
+
+        With more than one worker, the calls are spread over a pool of
+        threads, each with its own GkeysGPG instance.
+
+        @param func: function taking a GkeysGPG instance and a GKEY
+        @param gkeys: list of GKEY instances
+        @param workers: int, maximum number of worker threads
+        @returns list of the func() results, in the gkeys order
+        '''
+        get_gpg = self._thread_gpg()
+        if workers < 2 or len(gkeys) < 2:
+            return [func(get_gpg(), gkey) for gkey in gkeys]
+
+        def run(gkey):
+            return func(get_gpg(), gkey)
+
+        pool = ThreadPool(min(workers, len(gkeys)))
+        try:
+            return pool.map(run, gkeys)
+        finally:
+            pool.close()
@@ -30,16 +30,17 @@ from collections import defaultdict
 from gkeys.actionbase import ActionBase
 from gkeys.gkey import GKEY
 from gkeys.checks import SPECCHECK_SUMMARY, convert_pf, convert_yn
+from gkeys.seed import SEED_VERSION, Seeds
 
 from snakeoil.demandload import demandload
 
+from gkeys.fetcher import EXTENSIONS
+
 demandload(
     "gkeys.base:Args",
-    "json:load",
+    "gkeys.scheduler:KeyserverScheduler",
 )
 
-EXTENSIONS = ['.sig', '.asc', '.gpg','.gpgsig']
-
 
 class Actions(ActionBase):
     '''Primary API actions'''
@@ -86,12 +87,19 @@ class Actions(ActionBase):
         '''Download the selected seed file(s)'''
         self.logger.debug(_unicode("ACTIONS: fetchseed; args: %s")
             % _unicode(args))
-        if not args.category:
+        if args.category:
+            categories = [args.category]
+        else:
+            # fetch all of the categories with a seed file url
+            seedurls = self.config.get_key('seedurls') or {}
+            categories = sorted([cat for cat in self.config.get_key('seeds')
+                if cat in seedurls])
+        if not categories:
             return (False, ["Please specify seeds category."])
         self._set_category(self.config.get_key('verify-keyring'))
         verifyargs = Args()
-        verifyargs.category=args.category
-        success, messages = self.seedhandler.fetch_seeds(args.category, verifyargs, self.verify)
+        success, messages = self.seedhandler.fetch_seeds(categories,
+            verifyargs, self.verify, self.fetcher)
         messages.append("")
         messages.append("Fetch operation completed")
         return (False not in success, messages)
@@ -269,26 +277,21 @@ class Actions(ActionBase):
             # get confirmation
             # fill in code here
             self._set_category(args.category)
-            for gkey in gkeys:
-                self.gpg.set_keydir(gkey.keydir, "recv-keys")
-                self.gpg.set_keyseedfile()
-                seeds = self.gpg.seedfile.seeds
-                #print(seeds)
-                if seeds:
-                    self.logger.debug("ACTIONS: installkey; found installed seeds:"
-                        "\n %s" % seeds)
+            self.gpg.hold_index()
+            try:
+                installs = self._map_gpg(self._install_gkey, gkeys,
+                    self._workers('install-workers'))
+            finally:
+                self.gpg.release_index()
+            for gkey, (refreshed, added) in zip(gkeys, installs):
                 results = {}
                 failed = []
-                if gkey.nick in seeds and gkey.keys == seeds[gkey.nick].keys:
-                    self.logger.debug("ACTIONS: installkey; refreshing key:")
+                if refreshed:
                     if self.config.options['print_results']:
                         print(_unicode("Refreshing already installed key: %s, %s"
                             %(gkey.nick, gkey.keys)))
-                    self.gpg.refresh_key(gkey)
                 else:
-                    self.logger.debug("ACTIONS: installkey; adding key:")
-                    self.logger.debug("ACTIONS: " + str(gkey))
-                    results[gkey.name] = self.gpg.add_key(gkey)
+                    results[gkey.name] = added
                     for result in results[gkey.name]:
                         self.logger.debug("ACTIONS: installkey; result.failed = " +
                                           str(result.failed))
@@ -314,10 +317,37 @@ class Actions(ActionBase):
                 self.output([failed], "\n Failed to install:")
             if failed:
                 success = False
+            self.seedhandler.invalidate(args.category)
+            self.seedhandler.update_keyid_index()
             return (success, ["Completed"])
         return (success, ["No seeds to search or install"])
 
 
+    def _install_gkey(self, gpg, gkey):
+        '''Adds a key to its keydir, or refreshes it if it is installed
+
+        Runs in the installkey() worker threads.
+
+        @param gpg: GkeysGPG instance to use
+        @param gkey: GKEY instance to install
+        @returns tuple of True and None for a refreshed key, or of False
+            and the add_key() results
+        '''
+        gpg.set_keydir(gkey.keydir, "recv-keys")
+        gpg.set_keyseedfile()
+        seeds = gpg.seedfile.seeds
+        if seeds:
+            self.logger.debug("ACTIONS: installkey; found installed seeds:"
+                "\n %s" % seeds)
+        if gkey.nick in seeds and gkey.keys == seeds[gkey.nick].keys:
+            self.logger.debug("ACTIONS: installkey; refreshing key:")
+            gpg.refresh_key(gkey)
+            return (True, None)
+        self.logger.debug("ACTIONS: installkey; adding key:")
+        self.logger.debug("ACTIONS: " + str(gkey))
+        return (False, gpg.add_key(gkey))
+
+
     def checkkey(self, args):
         '''Check keys actions
         Performs basic validity checks on the key(s), checks expiry,
@@ -328,6 +358,8 @@ class Actions(ActionBase):
         seeds = self.seedhandler.load_category(args.category)
         self._set_category(args.category)
         results = {}
+        # one listing of each keydir for all of its keys
+        listings = {}
         failed = defaultdict(list)
         kwargs = self.seedhandler.build_gkeydict(args)
         keyresults = seeds.list(**kwargs)
@@ -340,8 +372,11 @@ class Actions(ActionBase):
                 _unicode(', ').join(gkey.pub_keyid))) +
                 _unicode("\n  =============================================="))
             self.logger.debug(_unicode("ACTIONS: checkkey; gkey = %s") % _unicode(gkey))
+            if gkey.keydir not in listings:
+                listings[gkey.keydir] = self.gpg.list_keydir(gkey.keydir)
             for key in gkey.pub_keyid:
-                results[gkey.name] = self.gpg.check_keys(gkey.keydir, key)
+                results[gkey.name] = self.gpg.check_keys(gkey.keydir, key,
+                    listings[gkey.keydir])
                 if results[gkey.name].expired:
                     failed['expired'].append(_unicode("%s <%s>: %s")
                         % (gkey.name, gkey.nick, key))
@@ -380,6 +415,7 @@ class Actions(ActionBase):
         catdir, keyresults = self.keyhandler.determine_keys(args)
         self.logger.debug(_unicode("ACTIONS: speccheck; catdir = %s") % catdir)
         results = {}
+        listings = {}
         failed = defaultdict(list)
         self.output('', '\n Checking keys...')
         for gkey in sorted(keyresults):
@@ -391,8 +427,11 @@ class Actions(ActionBase):
                 _unicode("\n  =============================================="))
             self.logger.debug(_unicode("ACTIONS: speccheck; gkey = %s")
                 % _unicode(gkey))
+            if gkey.keydir not in listings:
+                listings[gkey.keydir] = self.gpg.list_keydir(gkey.keydir)
             for key in gkey.keys:
-                results = self.gpg.speccheck(gkey.keydir, key)
+                results = self.gpg.speccheck(gkey.keydir, key,
+                    listings[gkey.keydir])
                 for g in results:
                     pub_pass = {}
                     for key in results[g]:
@@ -570,6 +609,8 @@ class Actions(ActionBase):
                         for key in gkey.keys:
                             success, msgs = self.gpg.del_key(gkey, key)
                             msgs.extend(msgs)
+        self.seedhandler.invalidate(args.category)
+        self.seedhandler.update_keyid_index()
         return (success, messages)
 
 
@@ -613,6 +654,7 @@ class Actions(ActionBase):
                 self.output([failed], "\n Failed to install:")
             if len(failed):
                 success = False
+            self.seedhandler.invalidate(args.category)
             return (success, ["Completed."])
         return (False, ["No seeds to search or install",
             "You must specify a category"])
@@ -626,26 +668,17 @@ class Actions(ActionBase):
             return (False, ["Please specify a category."])
         catdir = self._set_category(args.category)
         self.logger.debug("ACTIONS: installed; catdir = %s" % catdir)
-        installed_keys = []
-        try:
-            if args.nick:
-                keys = [args.nick]
-            else:
-                keys = os.listdir(catdir)
-            for key in keys:
-                seed_path = os.path.join(catdir, key)
-                gkey_path = os.path.join(seed_path, 'gkey.seeds')
-                seed = None
-                try:
-                    with open(gkey_path, 'r') as fileseed:
-                        seed = load(fileseed)
-                except IOError:
-                    return ["No seed file found in %s." % gkey_path, ""]
-                if seed:
-                    for val in list(seed.values()):
-                        installed_keys.append(GKEY(**val))
-        except OSError:
+        if not os.path.isdir(catdir):
             return (False, [_unicode("%s directory does not exist.") % catdir, ""])
+        if args.nick:
+            nicks = [args.nick]
+        else:
+            nicks = None
+        seeds = self.seedhandler.load_category(args.category, nicks)
+        if args.nick and not seeds.seeds:
+            gkey_path = os.path.join(catdir, args.nick, 'gkey.seeds')
+            return (False, ["No seed file found in %s." % gkey_path, ""])
+        installed_keys = list(seeds.seeds.values())
         return (True, ['Found Key(s):', installed_keys])
 
 
@@ -721,45 +754,21 @@ class Actions(ActionBase):
             climit = 0
         sig_path = None
         if isurl:
-            from sslfetch.connections import Connector
-            connector_output = {
-                 'info': self.logger.info,
-                 'debug': self.logger.debug,
-                 'error': self.logger.error,
-                 'exception': self.logger.exception,
-                 # we want any warnings to be printed to the terminal
-                 # so assign it to logging.error
-                 'warning': self.logger.error,
-                 'kwargs-info': {},
-                 'kwargs-debug': {},
-                 'kwargs-error': {},
-                 'kwargs-exception': {},
-                 'kwargs-warning': {},
-            }
-            fetcher = Connector(connector_output, None, "Gentoo Keys")
             self.logger.debug(
                 _unicode("ACTIONS: verify; fetching %s signed file ") % filepath)
             self.logger.debug(
                 _unicode("ACTIONS: verify; timestamp path: %s") % timestamp_path)
-            success, signedfile, timestamp = fetcher.fetch_file(
+            success, signedfile, timestamp = self.fetcher.fetch_file(
                 url, filepath, timestamp_path, climit=climit)
             if not success:
                 messages.append(_unicode("File %s cannot be retrieved.") % filepath)
             elif '.' + url.rsplit('.', 1)[1] not in EXTENSIONS:
                 if not signature:
-                    success_fetch = False
-                    for ext in EXTENSIONS:
-                        sig_path = filepath + ext
-                        if isurl:
-                            signature = url + ext
-                            self.logger.debug(
-                                _unicode("ACTIONS: verify; fetching %s signature ")
-                                % signature)
-                            success_fetch, sig, timestamp = fetcher.fetch_file(signature, sig_path)
-                        if success_fetch:
-                            break
-                        else:
-                            signature = None
+                    self.logger.debug(
+                        _unicode("ACTIONS: verify; fetching %s signature ")
+                        % url)
+                    signature, sig_path = self.fetcher.fetch_signature(
+                        url, filepath, EXTENSIONS)
         elif signature is not None and os.path.exists(signature):
             sig_path = signature
         else:
@@ -806,6 +815,57 @@ class Actions(ActionBase):
         return (verified, messages)
 
 
+    def migrate(self, args):
+        '''Upgrade the seed files and installed keys to the current format'''
+        if args.category:
+            categories = [args.category]
+        else:
+            categories = sorted(self.config.get_key('seeds'))
+        keyring = self.config.get_key('keyring')
+        seedfiles = []
+        for cat in categories:
+            seedfile = self.config.get_key('seeds', cat)
+            if seedfile and os.path.exists(seedfile):
+                seedfiles.append(seedfile)
+            catdir = os.path.join(keyring, cat)
+            try:
+                nicks = sorted(os.listdir(catdir))
+            except OSError:
+                self.logger.debug(_unicode("ACTIONS: migrate; no installed "
+                    "keys for category: %s") % cat)
+                continue
+            for nick in nicks:
+                gkey_path = os.path.join(catdir, nick, 'gkey.seeds')
+                if os.path.isfile(gkey_path):
+                    seedfiles.append(gkey_path)
+        migrated = []
+        failed = []
+        for seedfile in seedfiles:
+            seeds = Seeds(seedfile, self.config, self.logger)
+            try:
+                loaded = seeds.load(refresh=True, stream=True,
+                    cache=False)
+            except ValueError as err:
+                self.logger.warning(_unicode("ACTIONS: migrate; unreadable "
+                    "seed file %s: %s") % (seedfile, _unicode(err)))
+                loaded = False
+            if not loaded:
+                failed.append(seedfile)
+            elif seeds.version < SEED_VERSION:
+                self.logger.debug(_unicode("ACTIONS: migrate; upgrading %s "
+                    "from version %d") % (seedfile, seeds.version))
+                if seeds.save(force=True):
+                    migrated.append(seedfile)
+                else:
+                    failed.append(seedfile)
+        self.seedhandler.invalidate()
+        messages = [_unicode("Migrated %d of %d seed files to version %d")
+            % (len(migrated), len(seedfiles), SEED_VERSION)]
+        if failed:
+            messages.extend(["Failed to migrate:", failed])
+        return (not failed, messages)
+
+
     def listcats(self, args):
         '''List seed file definitions found in the config'''
         seeds = list(self.config.get_key('seeds'))
@@ -842,7 +902,7 @@ class Actions(ActionBase):
         task = self.config.get_key("sign", "type")
         keyring = self.config.get_key("sign", "keyring")
 
-        self.config.options['gpg_defaults'] = ['--status-fd', '2']
+        self.gpg.set_gpg_defaults(['--status-fd', '2'])
 
         self.logger.debug(_unicode("ACTIONS: sign; keydir = %s") % keydir)
 
@@ -880,20 +940,49 @@ class Actions(ActionBase):
             % _unicode(args))
         seeds = self.seedhandler.load_category(args.category, refresh=True)
         self._set_category(args.category)
-        results = {}
         kwargs = self.seedhandler.build_gkeydict(args)
-        keyresults = seeds.list(**kwargs)
-        self.output('', '\n Refreshig keys...')
-        for gkey in sorted(keyresults):
+        gkeys = sorted(seeds.list(**kwargs))
+        get_gpg = self._thread_gpg()
+        keyserver = self.gpg.server or self.config.get_key('keyserver')
+        scheduler = KeyserverScheduler(self._workers('refresh-workers'),
+            self._workers('keyserver-requests'), self.logger)
+
+        def refresh(gkey):
             self.logger.info(_unicode("Refreshig key %s, %s")
                 % (gkey.nick, gkey.pub_keyid))
-            self.output('', _unicode("  %s: %s")
-                % (gkey.name, ', '.join(gkey.pub_keyid)))
-            #self.output('', "  ===============")
             self.logger.debug(_unicode("ACTIONS: refreshkey; gkey = %s")
                 % _unicode(gkey))
-            results[gkey.keydir] = self.gpg.refresh_key(gkey)
-        return (True, ['Completed'])
+            return get_gpg().refresh_key(gkey)
+
+        def refreshed(outcome):
+            # reported as each refresh ends, so in completion order
+            self.output('', _unicode("  %s: %s%s")
+                % (outcome.item.name, ', '.join(outcome.item.pub_keyid),
+                    ' (failed)' if outcome.failed else ''))
+
+        self.output('', '\n Refreshig keys...')
+        self.gpg.hold_index()
+        try:
+            outcomes = scheduler.run(refresh, gkeys, lambda gkey: keyserver,
+                refreshed)
+        finally:
+            self.gpg.release_index()
+        self.seedhandler.invalidate(args.category)
+        self.seedhandler.update_keyid_index()
+        failed = [outcome for outcome in outcomes if outcome.failed]
+        if failed:
+            self.output('', '\n Failed to refresh:')
+            for outcome in failed:
+                if outcome.error is not None:
+                    reason = str(outcome.error)
+                else:
+                    reason = _unicode("gpg return code %s") \
+                        % outcome.result.returncode
+                self.output('', _unicode("  %s: %s, after %d attempt(s)")
+                    % (outcome.item.name, reason, outcome.attempts))
+        summary = _unicode("Refreshed %d of %d keys") \
+            % (len(outcomes) - len(failed), len(outcomes))
+        return (not failed, ['Completed', summary])
 
 
     def key_search(self, args, data_only=False):
@@ -0,0 +1,158 @@
+#
+#-*- coding:utf-8 -*-
+
+"""
+    Gentoo-keys - catindex.py
+
+    Aggregated index of the installed keys of a keyring category
+
+    The index file is stored in the category directory and holds the
+    gkey.seeds entries of all of its keydirs, along with the inode, size
+    and mtime of each keydir's gkey.seeds file (and journal) they were
+    read from.  A keydir's entries are only used while those still match.
+
+    @copyright: 2015 by Brian Dolbec <dol-sen@gentoo.org>
+    @license: GNU GPL2, see COPYING for details.
+"""
+
+import json
+import os
+import threading
+
+from gkeys.fileops import atomic_write, file_stamp
+from gkeys.gkey import GKEY
+
+
+INDEX_NAME = '.gkeys-index'
+INDEX_VERSION = 1
+
+SEEDFILE = 'gkey.seeds'
+JOURNAL_SUFFIX = '.journal'
+
+# serializes the read-modify-write of update_index() between threads
+_UPDATE_LOCK = threading.Lock()
+
+
+def index_path(catdir):
+    '''Returns the path of the index file of a category directory'''
+    return os.path.join(catdir, INDEX_NAME)
+
+
+def keydir_stamp(catdir, keydir):
+    '''Returns the stamp used to detect changes of a keydir's seeds
+
+    @param catdir: string, path of the category directory
+    @param keydir: string, name of the key directory
+    @returns list of the gkey.seeds file and journal [inode, size, mtime]
+        values, or None for a missing file
+    '''
+    gkey_path = os.path.join(catdir, keydir, SEEDFILE)
+    return [file_stamp(gkey_path), file_stamp(gkey_path + JOURNAL_SUFFIX)]
+
+
+def category_stamp(catdir):
+    '''Returns the stamp used to detect changes of a category
+
+    Adding or removing a keydir changes the category directory, and
+    changes to the installed keys are recorded by rewriting the index.
+
+    @param catdir: string, path of the category directory
+    @returns list of the directory and index file [inode, size, mtime]
+        values, or None for a missing one
+    '''
+    return [file_stamp(catdir), file_stamp(index_path(catdir))]
+
+
+def read_index(catdir, logger=None):
+    '''Reads the index of a category directory
+
+    @param catdir: string, path of the category directory
+    @param logger: optional logger instance
+    @returns dict of keydir: {'stamp': keydir_stamp(),
+        'seeds': {nick: GKEY._asdict()}}, empty if there is no usable index
+    '''
+    try:
+        with open(index_path(catdir), 'r') as indexfile:
+            data = json.load(indexfile)
+    except (IOError, OSError, ValueError) as err:
+        if logger:
+            logger.debug("CatIndex: read_index; no index for %s: %s"
+                % (catdir, str(err)))
+        return {}
+    if not isinstance(data, dict) or data.get('version') != INDEX_VERSION:
+        return {}
+    return data.get('keydirs', {})
+
+
+def write_index(catdir, keydirs, logger=None):
+    '''Writes the index of a category directory
+
+    Failures are not fatal, the keydirs are simply read again next time.
+
+    @param catdir: string, path of the category directory
+    @param keydirs: dict in the read_index() format
+    @param logger: optional logger instance
+    @returns boolean
+    '''
+    path = index_path(catdir)
+    try:
+        atomic_write(path, json.dumps({'version': INDEX_VERSION,
+            'keydirs': keydirs}, sort_keys=True))
+    except (IOError, OSError, TypeError, ValueError) as err:
+        if logger:
+            logger.debug("CatIndex: write_index; failed to write %s: %s"
+                % (path, str(err)))
+        return False
+    return True
+
+
+def index_record(catdir, keydir, entries, stamp=None):
+    '''Returns the index record of a keydir
+
+    @param entries: list of (nick, GKEY) tuples of the keydir
+    @param stamp: optional keydir_stamp() taken when the entries were read
+    '''
+    if stamp is None:
+        stamp = keydir_stamp(catdir, keydir)
+    seeds = {}
+    for nick, gkey in entries:
+        seeds[nick] = gkey._asdict()
+    return {'stamp': stamp, 'seeds': seeds}
+
+
+def record_entries(record):
+    '''Returns the sorted list of (nick, GKEY) tuples of an index record'''
+    return [(nick, GKEY(**record['seeds'][nick]))
+        for nick in sorted(record['seeds'])]
+
+
+def update_index(catdir, updates, logger=None):
+    '''Records the current entries of keydirs in the category index
+
+    The index is rewritten once for all of the keydirs, and not at all
+    if none of their records changed.
+
+    @param catdir: string, path of the category directory
+    @param updates: dict of keydir: list of (nick, GKEY) tuples,
+        or None to remove the keydir
+    @param logger: optional logger instance
+    @returns boolean
+    '''
+    if not os.path.exists(index_path(catdir)):
+        # nothing to keep current, load_category() creates it
+        return True
+    with _UPDATE_LOCK:
+        keydirs = read_index(catdir, logger)
+        changed = False
+        for keydir, entries in list(updates.items()):
+            if entries is None:
+                if keydirs.pop(keydir, None) is not None:
+                    changed = True
+                continue
+            record = index_record(catdir, keydir, entries)
+            if keydirs.get(keydir) != record:
+                keydirs[keydir] = record
+                changed = True
+        if not changed:
+            return True
+        return write_index(catdir, keydirs, logger)
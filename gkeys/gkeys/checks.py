@@ -164,6 +164,86 @@ class SpecCheck(namedtuple("SpecKey", list(SPEC_INDEX))):
         return data
 
 
+class KeyListing(object):
+    '''Colon listing of the keys of a keydir, parsed once
+
+    The records are grouped by primary key, each group starting with its
+    PUB record and holding the FPR, UID and SUB records following it.
+    '''
+
+    def __init__(self, records=None):
+        '''@param records: optional iterable of the colon listing records,
+                        as in pyGPG.output.GPGResult.status.data
+        '''
+        # primary key long keyid: list of its records
+        self.keys = OrderedDict()
+        # long keyid or fingerprint of a primary key or subkey:
+        # long keyid of the primary key
+        self._ids = {}
+        if records:
+            self.add(records)
+
+
+    def add(self, records):
+        '''Adds the key records of a colon listing'''
+        current = primary = None
+        for data in records:
+            if data.name == "PUB":
+                primary = data.long_keyid.upper()
+                current = self.keys[primary] = [data]
+                self._ids[primary] = primary
+            elif current is not None:
+                current.append(data)
+                if data.name == "SUB":
+                    self._ids[data.long_keyid.upper()] = primary
+                elif data.name == "FPR":
+                    self._ids[data.fingerprint.upper()] = primary
+
+
+    def records(self, keyid):
+        '''Returns the records of the primary key a keyid belongs to
+
+        @param keyid: long keyid or fingerprint of the primary key or
+                      of one of its subkeys, with an optional '0x'
+        @returns: list, empty if the key is not listed
+        '''
+        keyid = keyid.replace(' ', '').upper()
+        if keyid.startswith('0X'):
+            keyid = keyid[2:]
+        return self.keys.get(self._ids.get(keyid), [])
+
+
+    def select(self, keyids=None):
+        '''Returns the records of several keys
+
+        @param keyids: optional list of long keyids or fingerprints,
+                       all the listed keys if None
+        @returns: list of the records, in the listing order
+        '''
+        if keyids is None:
+            return [data for records in self.keys.values() for data in records]
+        selected = []
+        found = set()
+        for keyid in keyids:
+            records = self.records(keyid)
+            if records and records[0].long_keyid.upper() not in found:
+                found.add(records[0].long_keyid.upper())
+                selected.extend(records)
+        return selected
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def _key_records(result, keyid):
+    '''Returns the records of a key from a KeyListing, or all the records
+    of a GPGResult listing of that key'''
+    if isinstance(result, KeyListing):
+        return result.records(keyid)
+    return result.status.data
+
+
 class KeyChecks(object):
     '''Primary gpg key validation and specifications checks class'''
 
@@ -182,11 +262,12 @@ class KeyChecks(object):
 
         @param keydir: the keydir to list the keys for
         @param keyid: the keyid to check
-        @param result: pyGPG.output.GPGResult object
+        @param result: KeyListing of the keydir or pyGPG.output.GPGResult
+                       object of the key's listing
         @returns: GKEY_CHECK instance
         '''
         revoked = expired = invalid = sign = False
-        for data in result.status.data:
+        for data in _key_records(result, keyid):
             if data.name ==  "PUB":
                 if data.long_keyid == keyid[2:]:
                     # check if revoked
@@ -228,13 +309,20 @@ class KeyChecks(object):
 
 
     def spec_check(self, keydir, keyid, result):
-        '''Performs the minimum specifications checks on the key'''
+        '''Performs the minimum specifications checks on the key
+
+        @param keydir: the keydir to list the keys for
+        @param keyid: the keyid to check
+        @param result: KeyListing of the keydir or pyGPG.output.GPGResult
+                       object of the key's listing
+        @returns: dict of the primary long keyid: list of SpecCheck instances
+        '''
         self.logger.debug("SPEC_CHECK() : CHECKING: %s" % keyid)
         results = {}
         pub = None
         stats = None
         pub_days = 0
-        for data in result.status.data:
+        for data in _key_records(result, keyid):
             if data.name ==  "PUB":
                 if stats:
                     stats = self._test_final(data, stats)
@@ -315,11 +403,13 @@ class KeyChecks(object):
 
     def _test_version(self, data, stats):
         fpr_l = len(data.fingerprint)
-        if KEY_VERSION_FPR_LEN[fpr_l] in TEST_SPEC['versions']:
+        # an unknown fingerprint length is a key version we don't support
+        version = KEY_VERSION_FPR_LEN.get(fpr_l)
+        if version in TEST_SPEC['versions']:
             stats[SPEC_INDEX['version']] = True
         else:
             self.logger.debug("ERROR in key %s : invalid gpg key version: %s"
-                % (data.long_keyid, KEY_VERSION_FPR_LEN[fpr_l]))
+                % (data.long_keyid, version or "unknown"))
         return stats
 
 
@@ -73,6 +73,14 @@ class GKeysConfig(GPGConfig):
         self.defaults['seedsdir'] = '%(gkeysdir)s/seeds'
         self.defaults['seeds'] = {}
         self.defaults['keyserver'] = 'pool.sks-keyservers.net'
+        # append seed file changes to a journal, compacted periodically
+        self.defaults['seed-journal'] = 'no'
+        # number of keys installed at once by the install-key action
+        self.defaults['install-workers'] = '4'
+        # number of keys refreshed at once by the refresh-key action, and
+        # the maximum of them querying the same keyserver at a time
+        self.defaults['refresh-workers'] = '4'
+        self.defaults['keyserver-requests'] = '2'
         # NOTE: files is umask mode in octal, directories is chmod mode in octal
         self.defaults['permissions'] = {'files': '0o002', 'directories': '0o775',}
         self.defaults['seedurls'] = {}
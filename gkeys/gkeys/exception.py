@@ -67,8 +67,8 @@ class GkeysException(Exception):
 class UpdateDbError(GkeysException):
     '''%s
 
-    Please Run: 'gkeys refresh-key -C {foo}'
-    on all installed keyring categories
+    Please Run: 'gkeys migrate'
+    to upgrade the seed files and all installed keyring categories
     Then continue with normal gkey operations.'''
     def __init__(self, value):
         doc = self.__doc__ % (value)
@@ -0,0 +1,290 @@
+#
+#-*- coding:utf-8 -*-
+
+"""
+    Gentoo-keys - fetcher.py
+
+    HTTP(S) file downloads over a shared requests session
+
+    The ETag and Last-Modified validators of the downloaded files are kept
+    in a persistent cache and sent back in conditional requests, so an
+    unmodified file is neither downloaded nor verified again.
+
+    @copyright: 2015 by Brian Dolbec <dol-sen@gentoo.org>
+    @license: GNU GPL2, see COPYING for details.
+"""
+
+import json
+import os
+import threading
+import time
+
+from snakeoil.demandload import demandload
+
+demandload(
+    "requests",
+    "requests.adapters:HTTPAdapter",
+    "gkeys.fileops:atomic_write,file_stamp",
+)
+
+
+# signature file extensions probed for a signed file
+EXTENSIONS = ['.sig', '.asc', '.gpg','.gpgsig']
+
+# keep-alive connections kept per host
+POOL_SIZE = 4
+TIMEOUT = 30
+USER_AGENT = "Gentoo Keys"
+
+VALIDATORS_NAME = '.gkeys-validators'
+
+
+def validators_path(directory):
+    '''Returns the path of the validator cache of a download directory'''
+    return os.path.join(directory, VALIDATORS_NAME)
+
+
+class ValidatorCache(object):
+    '''Persistent map of the urls to the HTTP validators of their
+    downloaded files
+
+    An entry is only used while its file has the inode, size and mtime
+    it was saved with.  Entries are also flagged once the file passed
+    the gpg verification.
+    '''
+
+
+    def __init__(self, path=None, logger=None):
+        self.path = path
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._entries = None
+
+
+    def get(self, url, filepath=None):
+        '''Returns a copy of the entry of a url, or an empty dict
+
+        @param filepath: optional path the entry must still describe
+        '''
+        with self._lock:
+            entry = dict(self._load().get(url, {}))
+        if filepath is not None and (not entry or
+                entry.get('path') != filepath or
+                entry.get('stamp') != file_stamp(filepath)):
+            return {}
+        return entry
+
+
+    def update(self, url, **kwargs):
+        '''Updates and saves the entry of a url
+
+        A 'path' value records the current stamp of the file.
+        '''
+        with self._lock:
+            entry = self._load().setdefault(url, {})
+            entry.update(kwargs)
+            if 'path' in kwargs:
+                entry['stamp'] = file_stamp(kwargs['path'])
+            self._save()
+
+
+    def verified(self, url, filepath):
+        '''Returns True if the unchanged file of a url passed the
+        gpg verification'''
+        return self.get(url, filepath).get('verified', False)
+
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = {}
+            if self.path and os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r') as cachefile:
+                        self._entries = json.load(cachefile)
+                except (IOError, OSError, ValueError) as err:
+                    if self.logger:
+                        self.logger.debug("ValidatorCache: _load; ignoring %s: %s"
+                            % (self.path, str(err)))
+        return self._entries
+
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            atomic_write(self.path, json.dumps(self._entries, sort_keys=True))
+        except (IOError, OSError) as err:
+            if self.logger:
+                self.logger.debug("ValidatorCache: _save; failed to write %s: %s"
+                    % (self.path, str(err)))
+
+
+class Fetcher(object):
+    '''Downloads files over a single requests session
+
+    The session keeps a pool of keep-alive connections per host and
+    honors the http_proxy, https_proxy and no_proxy environment
+    variables.  A Fetcher instance can be shared by several threads.
+    '''
+
+
+    def __init__(self, logger, cache_path=None, useragent=USER_AGENT,
+            timeout=TIMEOUT, pool_size=POOL_SIZE):
+        self.logger = logger
+        self.cache = ValidatorCache(cache_path, logger)
+        self.useragent = useragent
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = None
+        self._lock = threading.Lock()
+
+
+    @property
+    def session(self):
+        '''The requests session, created on first use'''
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                session.headers.update({'User-Agent': self.useragent,
+                    'Accept-Charset': 'utf-8'})
+                adapter = HTTPAdapter(pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+
+    def fetch_file(self, url, filepath, timestamp_path=None, climit=0,
+            missing_ok=False):
+        '''Downloads a file
+
+        The ETag and Last-Modified validators of the cached download are
+        sent in the If-None-Match and If-Modified-Since headers, an
+        unmodified file is left in place.  Without a cache entry the
+        Last-Modified value stored in the timestamp file is used.
+
+        @param url: string, http(s) url of the file
+        @param filepath: string, path to save the file to
+        @param timestamp_path: optional string, path of the timestamp file
+        @param climit: int, seconds after the last check during which
+            the server is not contacted again
+        @param missing_ok: boolean, don't log a missing file as an error
+        @returns tuple of (success boolean, the new content or None if the
+            file was unmodified, the Last-Modified timestamp)
+        '''
+        entry = self.cache.get(url, filepath)
+        timestamp = entry.get('last-modified', '')
+        if (not entry and timestamp_path and os.path.exists(timestamp_path)
+                and os.path.exists(filepath)):
+            with open(timestamp_path, 'r') as tfile:
+                timestamp = tfile.read().strip()
+        if entry and climit and time.time() - entry.get('checked', 0) < climit:
+            self.logger.debug("Fetcher: fetch_file; %s was checked less "
+                "than %d seconds ago" % (url, climit))
+            return (True, None, timestamp)
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if timestamp:
+            headers['If-Modified-Since'] = timestamp
+        self.logger.debug("Fetcher: fetch_file; requesting %s" % url)
+        status, response_headers, content = self.request(url, headers)
+        if status == 304 and headers:
+            self.logger.info("Fetcher: fetch_file; %s is up to date" % url)
+            self.cache.update(url, path=filepath, checked=time.time(),
+                **{'last-modified': timestamp})
+            self._write_timestamp(timestamp_path, timestamp)
+            return (True, None, timestamp)
+        if status != 200:
+            log = self.logger.debug if missing_ok and status == 404 \
+                else self.logger.error
+            log("Fetcher: fetch_file; failed to fetch %s: %s" % (url, status))
+            return (False, '', '')
+        try:
+            atomic_write(filepath, content)
+        except (IOError, OSError) as err:
+            self.logger.error("Fetcher: fetch_file; failed to save %s: %s"
+                % (filepath, str(err)))
+            return (False, '', '')
+        timestamp = response_headers.get('last-modified', '')
+        self.cache.update(url, path=filepath, checked=time.time(),
+            etag=response_headers.get('etag', ''), verified=False,
+            **{'last-modified': timestamp})
+        self._write_timestamp(timestamp_path, timestamp)
+        return (True, content, timestamp)
+
+
+    def fetch_signature(self, url, filepath, extensions=None):
+        '''Downloads the detached signature of a file
+
+        The extension found last time is tried first.
+
+        @param url: string, url of the signed file
+        @param filepath: string, path of the signed file
+        @param extensions: list of the signature extensions to try in order
+        @returns tuple of the signature url and path, or (None, None)
+        '''
+        extensions = list(extensions or EXTENSIONS)
+        found = self.cache.get(url).get('signature')
+        if found in extensions:
+            extensions.remove(found)
+            extensions.insert(0, found)
+        for ext in extensions:
+            success, content, timestamp = self.fetch_file(url + ext,
+                filepath + ext, missing_ok=True)
+            if success:
+                if ext != found:
+                    self.cache.update(url, signature=ext)
+                return (url + ext, filepath + ext)
+        return (None, None)
+
+
+    def set_verified(self, urls, filepaths, verified=True):
+        '''Records the gpg verification result of downloaded files
+
+        @param urls: list of the urls of the signed file and its signature
+        @param filepaths: list of their paths
+        '''
+        for url, filepath in zip(urls, filepaths):
+            if self.cache.get(url, filepath):
+                self.cache.update(url, verified=verified)
+
+
+    def request(self, url, headers=None):
+        '''Sends a GET request, following redirects
+
+        @param url: string, http(s) url
+        @param headers: optional dict of extra request headers
+        @returns tuple of the status code (None if the server could not
+            be reached), a dict of the lower cased response headers and
+            the response body bytes
+        '''
+        try:
+            response = self.session.get(url, headers=headers,
+                timeout=self.timeout)
+        except requests.RequestException as err:
+            self.logger.error("Fetcher: request; %s failed: %s"
+                % (url, str(err)))
+            return (None, {}, b'')
+        response_headers = dict([(name.lower(), value)
+            for name, value in response.headers.items()])
+        return (response.status_code, response_headers, response.content)
+
+
+    @staticmethod
+    def _write_timestamp(timestamp_path, timestamp):
+        if not timestamp_path:
+            return
+        try:
+            with open(timestamp_path, 'w') as tfile:
+                tfile.write(timestamp)
+        except (IOError, OSError):
+            pass
+
+
+    def close(self):
+        '''Closes the session's connections'''
+        with self._lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
@@ -1,6 +1,14 @@
 import os
+import threading
+from snakeoil.demandload import demandload
 from snakeoil.osutils import (ensure_dirs as snakeoil_ensure_dirs)
 
+from gkeys.exception import UpdateDbError
+
+demandload(
+    "gkeys.seed:Seeds",
+)
+
 
 def ensure_dirs(path, gid=-1, uid=-1, mode=0o700, minimal=True, failback=None, fatal=False):
     '''Wrapper to snakeoil.osutil's ensure_dirs()
@@ -30,6 +38,58 @@ def ensure_dirs(path, gid=-1, uid=-1, mode=0o700, minimal=True, failback=None, f
     return succeeded
 
 
+def mtime_ns(stat):
+    '''Returns the mtime of an os.stat() result in nanoseconds'''
+    mtime = getattr(stat, 'st_mtime_ns', None)
+    if mtime is None:
+        # py2
+        mtime = int(stat.st_mtime * 10**9)
+    return mtime
+
+
+def file_stamp(path):
+    '''Returns the [inode, size, mtime (ns)] stamp of a file,
+    None if it is missing'''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_ino, stat.st_size, mtime_ns(stat)]
+
+
+def atomic_write(path, data, mode=None):
+    '''Writes a file through a temporary file which then replaces it,
+    so readers never see a partial file
+
+    The temporary file name is unique to the process and thread.
+
+    @param path: string, path of the file to write
+    @param data: bytes, or text which is written utf-8 encoded
+    @param mode: optional permissions of the file, defaults to the umask
+    @raises IOError or OSError, the temporary file is removed
+    '''
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    temp = '%s.%d.%d.tmp' % (path, os.getpid(),
+        threading.current_thread().ident)
+    try:
+        with open(temp, "wb") as outfile:
+            outfile.write(data)
+        if mode is not None:
+            os.chmod(temp, mode)
+        if hasattr(os, 'replace'):
+            os.replace(temp, path)
+        else:
+            # py2, rename is atomic on posix systems
+            os.rename(temp, path)
+    except (IOError, OSError):
+        try:
+            os.unlink(temp)
+        except OSError:
+            pass
+        raise
+
+
 def updatefiles(config, logger, category=None, filename = None):
     if category and not filename:
         filename = config.get_key('seeds', category)
@@ -37,6 +97,11 @@ def updatefiles(config, logger, category=None, filename = None):
         logger.error("MAIN: updatefiles();  category or filename not supplied")
         return False
     old = filename + '.old'
+    if os.path.exists(filename) and os.path.exists(filename + '.new'):
+        changes = diff_seedfiles(config, logger, filename, filename + '.new')
+        logger.info("Seed file changes: %d added, %d removed, %d changed"
+            % (len(changes.added), len(changes.removed), len(changes.changed)))
+        logger.debug("MAIN: updatefiles(); changes: %s" % str(changes))
     try:
         logger.info("Backing up existing file...")
         if os.path.exists(old):
@@ -61,3 +126,26 @@ def updatefiles(config, logger, category=None, filename = None):
         raise
         return False
     return True
+
+
+def diff_seedfiles(config, logger, old, new):
+    '''Compares two versions of a seed file
+
+    Both files are read with the streaming loader, one entry at a time.
+
+    @param old: string, path of the previous seed file
+    @param new: string, path of the updated seed file
+    @returns SeedsDiff of the added, removed and changed nicks
+    '''
+    seeds = []
+    for filename in [old, new]:
+        seed = Seeds(filename, config, logger)
+        try:
+            seed.load(refresh=True, stream=True, cache=False)
+        except (ValueError, UpdateDbError) as err:
+            # an unreadable seed file has no entries to compare
+            logger.warning("MAIN: diff_seedfiles(); unreadable seed file "
+                "%s: %s" % (filename, str(err)))
+            seed = Seeds(None, config, logger)
+        seeds.append(seed)
+    return seeds[1].diff(seeds[0])
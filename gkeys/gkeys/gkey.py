@@ -10,9 +10,13 @@
     @license: GNU GPL2, see COPYING for details.
 """
 
+import sys
 
 from collections import namedtuple
 
+if sys.version_info[0] >= 3:
+    from sys import intern
+
 
 GKEY_STRING = '''    ----------
     Name.........: %(name)s
@@ -30,24 +34,70 @@ GKEY_FINGERPRINTS = \
 '''
 
 
+def _intern(text):
+    '''Returns the shared copy of a seed string'''
+    try:
+        return intern(text)
+    except TypeError:
+        # py2 unicode or None
+        return text
+
+
+def _intern_list(values):
+    if values is None:
+        return None
+    return [_intern(x) for x in values]
+
+
+def _keyids(fingerprints):
+    '''Returns the list of the long keyids of the fingerprints'''
+    if fingerprints is None:
+        return None
+    return [_intern('0x' + x[-16:]) for x in fingerprints]
+
+
 class GKEY(namedtuple('GKEY', ['nick', 'name', 'keydir', 'keys', 'fingerprint', 'uid'])):
-    '''Class to hold the relavent info about a key'''
+    '''Class to hold the relavent info about a key
+
+    The strings are interned, so the many GKEY instances loaded for the
+    same seeds share a single copy of their nicks, fingerprints and uids.
+    The keyid lists are derived once, when the instance is created, and
+    kept outside of the tuple fields.
+    '''
 
     field_types = {'nick': str, 'name': str, 'keydir': str, 'keys': list,
         'fingerprint': list, 'uid': list}
-    __slots__ = ()
+
+
+    def __new__(cls, nick, name, keydir, keys, fingerprint, uid):
+        self = super(GKEY, cls).__new__(cls, _intern(nick), _intern(name),
+            _intern(keydir), _intern_list(keys), _intern_list(fingerprint),
+            _intern_list(uid))
+        self._keyid = _keyids(self.fingerprint)
+        self._pub_keyid = _keyids(self.keys)
+        return self
+
+
+    @classmethod
+    def _make(cls, iterable):
+        return cls(*iterable)
+
+
+    def __reduce__(self):
+        # rebuild through __new__ so copies and unpickled keys get their keyids
+        return (self.__class__, tuple(self))
 
 
     @property
     def keyid(self):
         '''Keyid is a substring value of the fingerprint'''
-        return ['0x' + x[-16:] for x in self.fingerprint]
+        return self._keyid
 
 
     @property
     def pub_keyid(self):
         '''Keyid is a substring value of the keys fingerprints'''
-        return ['0x' + x[-16:] for x in self.keys]
+        return self._pub_keyid
 
 
     @property
@@ -72,13 +122,16 @@ class GKEY(namedtuple('GKEY', ['nick', 'name', 'keydir', 'keys', 'fingerprint',
         and mines all fingerprints found.
 
         @param result_list: list of pyGPG.output.GPGResult instances
-            (one for each fingerprint in the list)
+            (one for each fingerprint in the list) or of lists of their
+            colon listing records
         @return: A new, updated GKEY instance
         '''
         fingerprints = set()
         uids = set()
         for result in result_list:
-            for data in result.status.data:
+            if hasattr(result, 'status'):
+                result = result.status.data
+            for data in result:
                 if data.name ==  "FPR":
                     fingerprints.add(data.fingerprint)
                 elif data.name ==  "UID":
@@ -10,8 +10,10 @@ from gkeys.gkey import GKEY
 
 demandload(
     "gkeys:log",
+    "gkeys.keymap:KEY_MAP",
     "gkeys.lib:GkeysGPG",
     "gkeys.seedhandler:SeedHandler",
+    "gkeys.watcher:new_watcher",
 )
 
 
@@ -40,14 +42,30 @@ class GkeysInterface(object):
         self.handler = None
 
 
+    def watch(self, polling=False):
+        '''Watches the keyrings and seed files for changes, so the loaded
+        categories are reused until they change
+
+        @param polling: boolean, poll the directories instead of
+            using inotify
+        '''
+        if not self.handler:
+            self.handler = SeedHandler(self.logger, self.config)
+        return self.handler.watch(new_watcher(self.logger, polling))
+
+
     def keyid_search(self, keyid):
         '''Searches for a keyid in the installed keyrings
 
         @param keyid: string of the longkeyid to search for
         @returns dictionary of  {category: [GKEY, ...]}
         '''
+        categories = list(self.config.get_key('seeds'))
+        results = KEY_MAP.search(self.handler, categories, 'keyid', keyid)
+        if results is not None:
+            return results
         results = {}
-        for cat in list(self.config.get_key('seeds')):
+        for cat in categories:
             self.handler.load_category(cat)
             found = self.handler.key_search({'keyid': keyid,}, ['keyid'])
             if found:
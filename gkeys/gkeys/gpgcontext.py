@@ -0,0 +1,114 @@
+#
+#-*- coding:utf-8 -*-
+
+"""
+    Gentoo-keys - gpgcontext.py
+
+    Immutable gpg invocation context
+
+    Holds the gpg options set for the calls of a GkeysGPG instance, on top
+    of the config's gpg_defaults and tasks templates.  Setting an option
+    returns a new context, and each gpg call gets its own copy of the
+    config built from it, so the shared config is never modified and the
+    instances can run gpg from several threads.
+
+    @copyright: 2015 by Brian Dolbec <dol-sen@gentoo.org>
+    @license: GNU GPL2, see COPYING for details.
+"""
+
+from collections import namedtuple
+from copy import copy
+
+
+class GPGContext(namedtuple('GPGContext', ['defaults', 'options', 'tasks'])):
+    '''The gpg options of an invocation
+
+    defaults: None to use the config's gpg_defaults, or a tuple of the
+              options replacing them
+    options: tuple of (option, tuple of its values) pairs added to the
+             gpg defaults, one pair per option
+    tasks: tuple of (task, tuple of options) pairs replacing the config's
+           options of a task
+    '''
+
+    __slots__ = ()
+
+
+    def __new__(cls, defaults=None, options=(), tasks=()):
+        return super(GPGContext, cls).__new__(cls, defaults, options, tasks)
+
+
+    def with_defaults(self, defaults):
+        '''Returns a context replacing the config's gpg_defaults
+
+        @param defaults: list of gpg options
+        '''
+        return self._replace(defaults=tuple(defaults))
+
+
+    def with_option(self, option, *values):
+        '''Returns a context adding or replacing a gpg default option
+
+        @param option: string, the option
+        @param values: its values
+        '''
+        options = [(name, value) for name, value in self.options
+            if name != option]
+        options.append((option, tuple(values)))
+        return self._replace(options=tuple(options))
+
+
+    def with_task(self, config, task, options, reset=True):
+        '''Returns a context adding options to a task
+
+        @param config: GKeysConfig instance holding the task templates
+        @param task: string, the gpg task
+        @param options: list of the options to add
+        @param reset: boolean, start from the config's default task options
+            instead of the current ones
+        '''
+        if reset:
+            current = config.defaults['tasks'][task]
+        else:
+            current = self.task_options(config, task)
+        tasks = [(name, value) for name, value in self.tasks if name != task]
+        tasks.append((task, tuple(current) + tuple(options)))
+        return self._replace(tasks=tuple(tasks))
+
+
+    def gpg_defaults(self, config):
+        '''Returns the list of the gpg default options'''
+        if self.defaults is None:
+            defaults = list(config.get_key('gpg_defaults') or [])
+        else:
+            defaults = list(self.defaults)
+        for option, values in self.options:
+            defaults.append(option)
+            defaults.extend(values)
+        return defaults
+
+
+    def task_options(self, config, task):
+        '''Returns the list of the options of a task'''
+        for name, options in self.tasks:
+            if name == task:
+                return list(options)
+        return list(config.get_key('tasks', task) or [])
+
+
+    def apply(self, config):
+        '''Returns a copy of a config holding the context's options
+
+        @param config: GKeysConfig instance, left unchanged
+        @returns GKeysConfig instance for a single gpg call
+        '''
+        call_config = copy(config)
+        call_config.options = dict(config.options)
+        tasks = dict(config.defaults.get('tasks', {}))
+        tasks.update(config.options.get('tasks', {}))
+        tasks = dict([(task, list(options)) for task, options in tasks.items()])
+        for task, options in self.tasks:
+            tasks[task] = list(options)
+        call_config.options['tasks'] = tasks
+        call_config.options['gpg_defaults'] = self.gpg_defaults(config)
+        return call_config
@@ -23,6 +23,7 @@ from  gkeys.gkey import GKEY
 
 
 demandload(
+    "gkeys.keymap:KEY_MAP",
     "gkeys.seedhandler:SeedHandler",
 )
 
@@ -81,23 +82,34 @@ class KeyHandler(object):
 
 
     def key_search(self, args, first_match=False):
-        '''Search for a key's seed in the installed keys db'''
+        '''Search for a key's seed in the installed keys db
+
+        @param args: argparse.parse_args instance
+        @param first_match: Boolean, stop the search at the first category
+            with a match, all of its matching keys are returned
+        @returns dict of category: list of GKEY instances
+        '''
         results = {}
         search_args = [x for x in KEY_OPTIONS if getattr(args, x)]
         if args.category:
-            self.seedhandler.load_category(args.category)
-            results[args.category] = self.seedhandler.key_search(args, search_args)
+            categories = [args.category]
         else:
-            for cat in sorted(self.config.get_key('seeds')):
-                self.seedhandler.load_category(cat)
-                found = self.seedhandler.key_search(args, search_args)
-                if found:
-                    if cat in results:
-                        results[cat].extend(found)
-                    else:
-                        results[cat] = found
-                    if first_match:
-                        break
+            categories = sorted(self.config.get_key('seeds'))
+            if len(search_args) == 1:
+                # a keyid or fingerprint is looked up in the installed keys map
+                mapped = KEY_MAP.search(self.seedhandler, categories,
+                    search_args[0], getattr(args, search_args[0]),
+                    getattr(args, 'exact', False), first_match)
+                if mapped is not None:
+                    results.update(mapped)
+                    categories = []
+        for cat in categories:
+            self.seedhandler.load_category(cat)
+            found = self.seedhandler.key_search(args, search_args)
+            if found or args.category:
+                results[cat] = found
+            if found and first_match:
+                break
         keys = {}
         for cat in results:
             keys[cat] = []
@@ -0,0 +1,201 @@
+#
+#-*- coding:utf-8 -*-
+
+"""
+    Gentoo-keys - keyidindex.py
+
+    Shared, memory mapped keyid index of all the installed keys
+
+    The index file is stored in the base keyring directory and is
+    regenerated, by atomically replacing it, whenever keys are installed,
+    refreshed or removed.  Readers mmap it and binary search its records,
+    so concurrent processes share it through the page cache and never
+    parse it.
+
+    Layout:  header, then the fixed width records sorted by long keyid
+    and fingerprint, then a blob of the NUL separated
+    'category, keydir, nick' strings the records point to.
+
+    @copyright: 2015 by Brian Dolbec <dol-sen@gentoo.org>
+    @license: GNU GPL2, see COPYING for details.
+"""
+
+import mmap
+import os
+import struct
+
+from binascii import hexlify, unhexlify
+
+from gkeys.fileops import atomic_write, mtime_ns
+
+
+INDEX_NAME = '.gkeys-keyids'
+INDEX_MAGIC = b'GKKI'
+INDEX_VERSION = 1
+
+# magic, version, number of records, offset of the strings blob
+HEADER = struct.Struct('<4sHIQ')
+# long keyid, fingerprint, offset of the record's strings in the blob
+RECORD = struct.Struct('<8s20sI')
+
+SEPARATOR = b'\x00'
+
+
+def keyid_index_path(keyring):
+    '''Returns the path of the keyid index in the base keyring directory'''
+    return os.path.join(keyring, INDEX_NAME)
+
+
+def write_keyid_index(path, entries, logger=None):
+    '''Writes the keyid index file
+
+    @param path: string, path of the index file
+    @param entries: iterable of (category, GKEY) tuples
+    @param logger: optional logger instance
+    @returns boolean
+    '''
+    records = []
+    blob = []
+    offsets = {}
+    size = 0
+    for category, gkey in entries:
+        strings = SEPARATOR.join([x.encode('utf-8')
+            for x in (category, gkey.keydir, gkey.nick)]) + SEPARATOR
+        if strings not in offsets:
+            offsets[strings] = size
+            blob.append(strings)
+            size += len(strings)
+        for fpr in gkey.fingerprint or []:
+            try:
+                binary = unhexlify(fpr.encode('ascii'))
+            except (TypeError, ValueError, UnicodeError):
+                continue
+            if len(binary) != 20:
+                continue
+            records.append((binary[-8:], binary, offsets[strings]))
+    records.sort()
+    data = [HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(records),
+        HEADER.size + RECORD.size * len(records))]
+    data.extend([RECORD.pack(*record) for record in records])
+    data.extend(blob)
+    try:
+        atomic_write(path, b''.join(data))
+    except (IOError, OSError) as err:
+        if logger:
+            logger.debug("KeyidIndex: write_keyid_index; failed to write %s: %s"
+                % (path, str(err)))
+        return False
+    if logger:
+        logger.debug("KeyidIndex: write_keyid_index; wrote %d keyids to %s"
+            % (len(records), path))
+    return True
+
+
+class KeyidIndex(object):
+    '''Read only access to a memory mapped keyid index file'''
+
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._stat = None
+        self._count = 0
+        self._strings = 0
+        # mtime in nanoseconds of the mapped index file
+        self.mtime = None
+
+
+    def lookup(self, keyid):
+        '''Finds the installed keys with a long keyid or fingerprint
+
+        @param keyid: string, 16 or 40 hex digits long with an optional '0x'
+        @returns list of (category, keydir, nick, fingerprint) tuples,
+            None if there is no usable index or keyid is not a full one
+        '''
+        keyid = keyid.replace(' ', '')
+        if keyid[:2] in ['0x', '0X']:
+            keyid = keyid[2:]
+        try:
+            binary = unhexlify(keyid.encode('ascii'))
+        except (TypeError, ValueError, UnicodeError):
+            return None
+        if len(binary) not in [8, 20] or not self._open():
+            return None
+        mapped = self._map
+        # bisect for the first record of the keyid
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * RECORD.size
+            if mapped[offset:offset + 8] < binary[-8:]:
+                low = middle + 1
+            else:
+                high = middle
+        found = []
+        for index in range(low, self._count):
+            short, fpr, strings = RECORD.unpack_from(mapped,
+                HEADER.size + index * RECORD.size)
+            if short != binary[-8:]:
+                break
+            if len(binary) == 20 and fpr != binary:
+                continue
+            start = self._strings + strings
+            category, keydir, nick = [x.decode('utf-8') for x in
+                mapped[start:self._record_end(start)].split(SEPARATOR)[:3]]
+            found.append((category, keydir, nick,
+                hexlify(fpr).decode('ascii').upper()))
+        return found
+
+
+    def _record_end(self, start):
+        '''Returns the end offset of the strings of a record'''
+        end = start
+        for field in range(3):
+            end = self._map.find(SEPARATOR, end) + 1
+        return end
+
+
+    def _open(self):
+        '''Maps the index file, or its new version if it was replaced
+
+        @returns boolean
+        '''
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.close()
+            return False
+        mtime = mtime_ns(stat)
+        if self._map is not None and (stat.st_ino, mtime) == self._stat:
+            return True
+        self.close()
+        try:
+            with open(self.path, 'rb') as indexfile:
+                mapped = mmap.mmap(indexfile.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return False
+        if len(mapped) < HEADER.size:
+            mapped.close()
+            return False
+        magic, version, count, strings = HEADER.unpack_from(mapped, 0)
+        if (magic != INDEX_MAGIC or version != INDEX_VERSION or
+                strings != HEADER.size + count * RECORD.size or
+                strings > len(mapped)):
+            mapped.close()
+            return False
+        self._map = mapped
+        self._stat = (stat.st_ino, mtime)
+        self.mtime = mtime
+        self._count = count
+        self._strings = strings
+        return True
+
+
+    def close(self):
+        '''Unmaps the index file'''
+        if self._map is not None:
+            self._map.close()
+        self._map = None
+        self._stat = None
+        self.mtime = None
@@ -0,0 +1,167 @@
+#
+#-*- coding:utf-8 -*-
+
+"""
+    Gentoo-keys - keymap.py
+
+    Process wide map of the installed keys' long keyids and fingerprints
+
+    Each category's map is built from one load_category() and reused
+    until the category's directory or installed keys index changes,
+    so finding the installed key of a signature is a dictionary lookup.
+    While the shared keyid index is current, its binary search finds
+    the keydirs to load instead, without loading whole categories.
+
+    @copyright: 2015 by Brian Dolbec <dol-sen@gentoo.org>
+    @license: GNU GPL2, see COPYING for details.
+"""
+
+import re
+
+from gkeys.catindex import category_stamp
+from gkeys.keyidindex import KeyidIndex, keyid_index_path
+
+
+HEX_RE = re.compile(r'^[0-9A-Fa-f]+$')
+
+# search field: length of the hex values which can be looked up
+MAP_FIELDS = {'keyid': 16, 'fingerprint': 40}
+
+
+class KeyMap(object):
+    '''Maps the long keyids and fingerprints of the installed keys
+    of every category to their GKEY instances'''
+
+
+    def __init__(self):
+        # catdir: dict of the category name, its stamp and field maps
+        self._catdirs = {}
+        self._index = None
+
+
+    def search(self, seedhandler, categories, field, value, exact=False,
+            first_match=False):
+        '''Looks up the installed keys matching a keyid or fingerprint
+
+        Gives the same results as a SeedHandler.key_search() of each
+        category on that one field.
+
+        @param seedhandler: SeedHandler instance used to load the categories
+        @param categories: list of the category names to search, in order
+        @param field: string, 'keyid' or 'fingerprint'
+        @param value: string or list of strings to search for
+        @param exact: Boolean, case sensitive matching, not supported
+        @param first_match: Boolean, stop at the first category with a match
+        @returns dict of category: list of GKEY instances sorted by nick,
+            or None if the search can not be done with the map
+        '''
+        keys = self.map_keys(field, value, exact)
+        if keys is None:
+            return None
+        results = self._indexed(seedhandler, categories, field, keys,
+            first_match)
+        if results is not None:
+            return results
+        results = {}
+        for cat in categories:
+            fieldmap = self._category(seedhandler, cat)[field]
+            found = {}
+            for key in keys:
+                for gkey in fieldmap.get(key, []):
+                    found[gkey.nick] = gkey
+            if found:
+                results[cat] = [found[nick] for nick in sorted(found)]
+                if first_match:
+                    break
+        return results
+
+
+    @staticmethod
+    def map_keys(field, value, exact=False):
+        '''Returns the map keys for the search values, or None if
+        one of them needs a substring or case sensitive search'''
+        if field not in MAP_FIELDS or exact:
+            return None
+        keys = []
+        for key in (value if isinstance(value, list) else [value]):
+            key = (key or '').replace(' ', '').upper()
+            if field == 'keyid' and key[:2] == '0X':
+                key = key[2:]
+            if len(key) != MAP_FIELDS[field] or not HEX_RE.match(key):
+                return None
+            keys.append(key)
+        return keys
+
+
+    def _indexed(self, seedhandler, categories, field, keys, first_match):
+        '''Looks up the keys in the shared keyid index
+
+        @returns the search() results, or None if the index is missing,
+            older than one of the categories or does not match their keys
+        '''
+        path = keyid_index_path(seedhandler.config.get_key('keyring'))
+        if self._index is None or self._index.path != path:
+            self._index = KeyidIndex(path)
+        # category: {keydir: set of the matched fingerprints}
+        hits = {}
+        for key in keys:
+            found = self._index.lookup(key)
+            if found is None:
+                return None
+            for cat, keydir, nick, fpr in found:
+                hits.setdefault(cat, {}).setdefault(keydir, set()).add(fpr)
+        if self._index.mtime is None:
+            # no key was looked up, the index file is not loaded yet
+            return None
+        for cat in categories:
+            for stamp in category_stamp(seedhandler.category_dir(cat)):
+                if stamp is not None and stamp[2] > self._index.mtime:
+                    return None
+        results = {}
+        for cat in categories:
+            if cat not in hits:
+                continue
+            seeds = seedhandler.load_category(cat, sorted(hits[cat]))
+            found = {}
+            for gkey in list(seeds.seeds.values()):
+                fprs = set([fpr.upper() for fpr in gkey.fingerprint or []])
+                if fprs.intersection(hits[cat].get(gkey.keydir, [])):
+                    found[gkey.nick] = gkey
+            if set([gkey.keydir for gkey in found.values()]) != set(hits[cat]):
+                # the index is out of date
+                return None
+            results[cat] = [found[nick] for nick in sorted(found)]
+            if first_match:
+                break
+        return results
+
+
+    def invalidate(self, catdir=None):
+        '''Drops the map of a category directory, or of all of them'''
+        if catdir is None:
+            self._catdirs = {}
+        else:
+            self._catdirs.pop(catdir, None)
+
+
+    def _category(self, seedhandler, category):
+        '''Returns the current maps of a category, rebuilding them
+        if the category changed'''
+        catdir = seedhandler.category_dir(category)
+        entry = self._catdirs.get(catdir)
+        if (entry is not None and entry['category'] == category and
+                entry['stamp'] == category_stamp(catdir)):
+            return entry
+        seeds = seedhandler.load_category(category)
+        entry = {'category': category, 'stamp': category_stamp(catdir),
+            'keyid': {}, 'fingerprint': {}}
+        for gkey in list(seeds.seeds.values()):
+            for fpr in gkey.fingerprint or []:
+                fpr = fpr.upper()
+                entry['fingerprint'].setdefault(fpr, []).append(gkey)
+                entry['keyid'].setdefault(fpr[-16:], []).append(gkey)
+        self._catdirs[catdir] = entry
+        return entry
+
+
+KEY_MAP = KeyMap()
@@ -22,16 +22,29 @@ from __future__ import print_function
 
 import os
 
+from collections import namedtuple
+from copy import copy
 from os.path import abspath, pardir
 from os.path import join as pjoin
 from shutil import rmtree
 
 from pyGPG.gpg import GPG
-from gkeys.checks import KeyChecks
+from gkeys.catindex import update_index
+from gkeys.checks import KeyChecks, KeyListing
 from gkeys.fileops import ensure_dirs
+from gkeys.gpgcontext import GPGContext
+from gkeys.keymap import KEY_MAP
+from gkeys.listcache import (clear_listing, keyring_stamp, read_listing,
+    write_listing)
+from gkeys.openpgp import keyring_listing
 from gkeys.seed import Seeds
 
 
+# outcome of receiving one of a GKEY's fingerprints
+RecvResult = namedtuple('RecvResult', ['fingerprint', 'username', 'failed',
+    'returncode', 'stderr_out'])
+
+
 class GkeysGPG(GPG):
     '''Gentoo-keys primary gpg class'''
 
@@ -49,6 +62,40 @@ class GkeysGPG(GPG):
         self.logger = logger
         self.keydir = None
         self.server = None
+        # gpg options of the calls, the shared config is never modified
+        self.context = GPGContext()
+        # catdir: {keydir: seed entries} of the index updates held back
+        # by hold_index(), None when the index is updated on each change
+        self._index_updates = None
+
+
+    def fork(self):
+        '''Returns a new GkeysGPG instance for use by another thread
+
+        It shares the config and starts from the same invocation context.
+        '''
+        gpg = self.__class__(self.config, self.basedir, self.logger)
+        gpg.server = self.server
+        gpg.context = self.context
+        gpg._index_updates = self._index_updates
+        return gpg
+
+
+    def runGPG(self, task=None, inputfile=None, inputtxt=None):
+        '''Runs gpg with the options of the current invocation context
+
+        pyGPG reads the options from a copy of the config made for this
+        call only.
+        '''
+        runner = copy(self)
+        runner.config = self.context.apply(self.config)
+        return GPG.runGPG(runner, task=task, inputfile=inputfile,
+            inputtxt=inputtxt)
+
+
+    def task_options(self, task):
+        '''Returns the list of the gpg options a task will run with'''
+        return self.context.task_options(self.config, task)
 
 
     def set_keyserver(self, server=None):
@@ -57,33 +104,43 @@ class GkeysGPG(GPG):
         if self.server and not server:
             return
         self.server = server or self.config['keyserver']
-        self.config.options['gpg_defaults'] = self.config.defaults['gpg_defaults'][:]
         self.logger.debug("keyserver: %s" % (self.server))
-        server_value = ['--keyserver', self.server]
-        self.config.options['gpg_defaults'].extend(server_value)
-        self.logger.debug("self.config.options['gpg_defaults']: %s"
-            % (self.config.options['gpg_defaults']))
+        self.context = self.context.with_option('--keyserver', self.server)
+        self.logger.debug("gpg_defaults: %s"
+            % (self.context.gpg_defaults(self.config)))
         return
 
 
+    def set_trust(self, trust):
+        '''Set the --trust-model option of the gpg defaults'''
+        self.context = self.context.with_option('--trust-model', trust)
+
+
+    def set_gpg_defaults(self, defaults):
+        '''Replace the config's gpg defaults for the calls of this instance
+
+        @param defaults: list of gpg options
+        '''
+        self.context = self.context.with_defaults(defaults)
+
+
     def set_keyring(self, keyring, task, importkey=False, reset=True):
         '''Sets the keyring to use as well as related task options
         '''
         self.logger.debug("keydir: %s, keyring: %s" % (self.keydir, keyring))
-        if reset:
-            self.config.options['tasks'][task] =  self.config.defaults['tasks'][task][:]
+        task_value = []
         # --keyring file |  Note that this adds a keyring to the current list.
         # If the intent is to use the specified keyring alone,
         # use  --keyring  along with --no-default-keyring.
         if importkey:
-            task_value = ['--import-options', 'import-clean']
-            self.config.options['tasks'][task].extend(task_value)
+            task_value.extend(['--import-options', 'import-clean'])
             parent_dir = abspath(pjoin(keyring, pardir))
             ensure_dirs(parent_dir,
                 mode=int(self.config.get_key('permissions', 'directories'),0))
-        task_value = ['--no-default-keyring', '--keyring', keyring]
-        self.config.options['tasks'][task].extend(task_value)
-        self.logger.debug("set_keyring: New task options: %s" %str(self.config.options['tasks'][task]))
+        task_value.extend(['--no-default-keyring', '--keyring', keyring])
+        self.context = self.context.with_task(self.config, task, task_value,
+            reset)
+        self.logger.debug("set_keyring: New task options: %s" %str(self.task_options(task)))
         return
 
 
@@ -91,14 +148,13 @@ class GkeysGPG(GPG):
         self.logger.debug("basedir: %s, keydir: %s" % (self.basedir, keydir))
         self.keydir = pjoin(self.basedir, keydir)
         self.task = task
-        if reset:
-            self.config.options['tasks'][task] = self.config.defaults['tasks'][task][:]
         task_value = []
         if fingerprint:
             task_value.append('--fingerprint')
         task_value.extend(['--homedir', self.keydir])
-        self.config.options['tasks'][task].extend(task_value)
-        self.logger.debug("set_keydir: New task options: %s" %str(self.config.options['tasks'][task]))
+        self.context = self.context.with_task(self.config, task, task_value,
+            reset)
+        self.logger.debug("set_keydir: New task options: %s" %str(self.task_options(task)))
         return
 
 
@@ -115,11 +171,12 @@ class GkeysGPG(GPG):
         results = []
         self.logger.debug("LIB: import_to_keyring; name: " + gkey.name)
         self.logger.debug("** Calling runGPG with Running: gpg %s --import' for: %s"
-                     % (' '.join(self.config.get_key('tasks', 'import')),
+                     % (' '.join(self.task_options('import')),
                         gkey.name))
         pubring_path = pjoin(self.keydir, gkey.keydir, 'pubring.gpg')
         result = self.runGPG(task='import', inputfile=pubring_path)
         self.logger.info('GPG return code: ' + str(result.returncode))
+        clear_listing(self.keydir)
         results.append(result)
         print(result.stderr_out)
         return results
@@ -128,10 +185,14 @@ class GkeysGPG(GPG):
     def add_key(self, gkey):
         '''Add the specified key to the specified keydir
 
+        All of the gkey's fingerprints are received by one gpg run, then
+        checked against one colon listing of them.
+
         @param gkey: GKEY namedtuple with
             (name, nick, keydir, fingerprint)
+        @returns list of RecvResult instances, one for each fingerprint
         '''
-        self.config.defaults['gpg_defaults'].append('--no-permission-warning')
+        self.context = self.context.with_option('--no-permission-warning')
         self.set_keyserver()
         self.set_keydir(gkey.keydir, 'recv-keys', reset=True)
         self.set_keyring('pubring.gpg', 'recv-keys', reset=False)
@@ -139,36 +200,95 @@ class GkeysGPG(GPG):
         mode = int(self.config.get_key('permissions', 'directories'),0)
         ensure_dirs(str(self.keydir), mode=mode)
         self.set_keyseedfile(trap_errors=True)
+        fingerprints = list(gkey.keys or [])
+        if not fingerprints:
+            self.logger.error("GkeysGPG.add_key(); no fingerprints for: " + gkey.nick)
+            return []
+        self.logger.debug("LIB: add_key; adding fingerprints " + ' '.join(fingerprints))
+        self.logger.debug("** Calling runGPG with Running 'gpg %s --recv-keys %s' for: %s"
+            % (' '.join(self.task_options('recv-keys')),
+                ' '.join(fingerprints), gkey.name))
+        result = self.runGPG(task='recv-keys', inputfile=fingerprints)
+        self.logger.info('GPG return code: ' + str(result.returncode))
+        clear_listing(self.keydir)
+        records = self.list_keydir(gkey.keydir).select(fingerprints)
+        installed = self._listed_keys(records)
+        imported, problems = self._import_status(result)
         results = []
-        for fingerprint in gkey.keys:
-            self.logger.debug("LIB: add_key; adding fingerprint " + fingerprint)
-            self.logger.debug("** Calling runGPG with Running 'gpg %s --recv-keys %s' for: %s"
-                % (' '.join(self.config.get_key('tasks', 'recv-keys')),
-                    fingerprint, gkey.name))
-            result = self.runGPG(task='recv-keys', inputfile=fingerprint)
-            self.logger.info('GPG return code: ' + str(result.returncode))
-            if result.fingerprint in gkey.keys:
-                result.failed = False
+        for fingerprint in fingerprints:
+            fpr = fingerprint.upper()
+            uids = installed.get(fpr)
+            if imported or problems:
+                failed = fpr not in imported or fpr in problems
+            else:
+                # no import status, a key already in the keyring
+                # may not have been received
+                failed = bool(result.returncode) or uids is None
+            if not failed:
                 message = "Fingerprints match... Import successful: "
                 message += "%s, fingerprint: %s" % (gkey.nick, fingerprint)
-                message += "\n result len: %s, %s" % (len(result.fingerprint), result.fingerprint)
-                message += "\n gkey len: %s, %s" % (len(gkey.fingerprint[0]), gkey.fingerprint[0])
                 self.logger.info(message)
             else:
-                result.failed = True
                 message = "Fingerprints do not match... Import failed for "
                 message += "%s, fingerprint: %s" % (gkey.nick, fingerprint)
-                message += "\n result: %s" % (result.fingerprint)
+                message += "\n installed: %s" % (', '.join(sorted(installed)))
                 message += "\n gkey..: %s" % (str(gkey.fingerprint))
                 self.logger.error(message)
-            # Save the gkey seed to the installed db
-            success = self.update_gkey(gkey, save=True)
-            if not success:
-                return []
-            results.append(result)
+            results.append(RecvResult(fingerprint, (uids or [''])[0],
+                failed, result.returncode, result.stderr_out))
+        # Save the gkey seed to the installed db
+        self.seedfile.update(gkey.update([records]))
+        if not self.seedfile.save():
+            self.logger.error("GkeysGPG.add_key(); failed to save seed: " + gkey.nick)
+            return []
+        self._update_index(gkey.keydir, list(self.seedfile.seeds.items()))
         return results
 
 
+    @staticmethod
+    def _import_status(result):
+        '''Returns the fingerprints of gpg's IMPORT_OK and IMPORT_PROBLEM
+        status messages
+
+        @param result: pyGPG.output.GPGResult instance of an import
+        @returns tuple of the sets of the imported and the failed
+            upper cased fingerprints
+        '''
+        imported = set()
+        problems = set()
+        status = getattr(result, 'status', None)
+        for data in getattr(status, 'data', None) or []:
+            fingerprint = (getattr(data, 'fingerprint', '') or '').upper()
+            if data.name == "IMPORT_OK":
+                imported.add(fingerprint)
+            elif data.name == "IMPORT_PROBLEM":
+                problems.add(fingerprint)
+        return imported, problems
+
+
+    @staticmethod
+    def _listed_keys(records):
+        '''Returns the primary keys of a colon listing
+
+        @param records: list of the colon listing records
+        @returns dict of the primary key fingerprint: list of its uids
+        '''
+        keys = {}
+        current = None
+        primary = False
+        for data in records:
+            if data.name == "PUB":
+                current = None
+                primary = True
+            elif data.name == "SUB":
+                primary = False
+            elif data.name == "FPR" and primary and current is None:
+                current = keys.setdefault(data.fingerprint.upper(), [])
+            elif data.name == "UID" and current is not None:
+                current.append(data.user_ID)
+        return keys
+
+
     def del_key(self, gkey, key):
         '''Delete the specified key
 
@@ -181,9 +301,10 @@ class GkeysGPG(GPG):
         self.logger.debug("LIB: del_key, gkey: %s" % str(gkey))
         self.logger.debug("LIB: del_key, key: %s" % key)
         self.logger.debug("** Calling runGPG with: 'gpg %s --delete-keys' for: %s"
-            % (' '.join(self.config.get_key('tasks', 'delete-keys')), str(gkey)))
+            % (' '.join(self.task_options('delete-keys')), str(gkey)))
         result = self.runGPG(task='delete-keys', inputfile=key)
         self.logger.info('GPG return code: ' + str(result.returncode))
+        clear_listing(self.keydir)
         self.update_gkey(gkey, save=True)
         return (False, [])
 
@@ -200,6 +321,7 @@ class GkeysGPG(GPG):
             rmtree(rm_candidate)
             messages.append("Done removing %s key." % gkey.nick)
             success = True
+            self._update_index(gkey.keydir, None)
         except OSError:
             messages.append("%s directory does not exist or is a symbolic link." % rm_candidate)
         return (success, messages)
@@ -211,16 +333,17 @@ class GkeysGPG(GPG):
         @param key: tuple of (name, nick, keydir, fingerprint)
         @param keydir: the keydir to add the key to
         '''
-        self.config.defaults['gpg_defaults'].append('--no-permission-warning')
+        self.context = self.context.with_option('--no-permission-warning')
         self.set_keyserver()
         self.set_keydir(gkey.keydir, 'refresh-keys', reset=True)
         self.set_keyring('pubring.gpg', 'refresh-keys', reset=False)
         self.set_keyseedfile(refresh=True)
         self.logger.debug("LIB: refresh_key, gkey: %s" % str(gkey))
         self.logger.debug("** Calling runGPG with Running 'gpg %s --refresh-keys' for: %s"
-            % (' '.join(self.config.get_key('tasks', 'refresh-keys')), str(gkey)))
+            % (' '.join(self.task_options('refresh-keys')), str(gkey)))
         result = self.runGPG(task='refresh-keys', inputfile='')
         self.logger.info('GPG return code: ' + str(result.returncode))
+        clear_listing(self.keydir)
         self.update_gkey(gkey, save=True)
         return result
 
@@ -233,21 +356,53 @@ class GkeysGPG(GPG):
         '''
         # Update the gkey seed and save it to the installed db
         lresults = []
-        for fpr in gkey.keys:
-            lresults.append(self.list_keys(gkey.keydir, fpr, colons=True))
+        if gkey.keys:
+            lresults.append(self.list_keydir(gkey.keydir).select(gkey.keys))
         self.seedfile.update(gkey.update(lresults))
-        if save and not self.seedfile.save():
-            self.logger.error("GkeysGPG.update_gkey(); failed to save seed: " + gkey.nick)
-            return False
+        if save:
+            if not self.seedfile.save():
+                self.logger.error("GkeysGPG.update_gkey(); failed to save seed: " + gkey.nick)
+                return False
+            self._update_index(gkey.keydir, list(self.seedfile.seeds.items()))
         return True
 
 
+    def _update_index(self, keydir, entries):
+        '''Records the saved keydir seeds in the category's installed keys index
+
+        @param keydir: string, name of the key directory
+        @param entries: list of (nick, GKEY) tuples, None if it was removed
+        '''
+        if self._index_updates is not None:
+            self._index_updates.setdefault(self.basedir, {})[keydir] = entries
+            return
+        update_index(self.basedir, {keydir: entries}, self.logger)
+        KEY_MAP.invalidate(self.basedir)
+
+
+    def hold_index(self):
+        '''Collects the installed keys index updates of this instance and
+        of its forks until release_index(), which writes each category's
+        index once'''
+        if self._index_updates is None:
+            self._index_updates = {}
+
+
+    def release_index(self):
+        '''Writes the index updates collected since hold_index()'''
+        updates, self._index_updates = self._index_updates, None
+        for catdir, keydirs in list((updates or {}).items()):
+            update_index(catdir, keydirs, self.logger)
+            KEY_MAP.invalidate(catdir)
+
+
 
     def list_keys(self, keydir, fingerprint=None, colons=False):
         '''List all keys in the specified keydir or
         all keys in all keydir if keydir=None
 
         @param keydir: the keydir to list the keys for
+        @param fingerprint: optional fingerprint or list of fingerprints
         @param colons: bool to enable colon listing
         '''
         if not keydir:
@@ -262,28 +417,60 @@ class GkeysGPG(GPG):
             task = 'list-keys'
             target = ''
             self.set_keydir(keydir, task, fingerprint=False)
-        self.config.options['tasks'][task].extend(['--keyid-format', 'long', '--fingerprint'])
+        task_value = ['--keyid-format', 'long', '--fingerprint']
         if colons:
-            task_value = ['--with-colons']
-            self.config.options['tasks'][task].extend(task_value)
+            task_value.append('--with-colons')
+        self.context = self.context.with_task(self.config, task, task_value,
+            reset=False)
         self.logger.debug("** Calling runGPG with Running 'gpg %s --%s %s'"
-            % (' '.join(self.config['tasks'][task]), task, target)
+            % (' '.join(self.task_options(task)), task,
+                ' '.join(target) if isinstance(target, list) else target)
             )
         result = self.runGPG(task=task, inputfile=target)
         self.logger.info('GPG return code: ' + str(result.returncode))
         return result
 
 
+    def list_keydir(self, keydir):
+        '''Lists all the keys of a keydir
+
+        The keyring is read without running gpg, which is only used for
+        a keyring that can not be parsed.  The listing is cached in the
+        keydir until its keyring changes.
+
+        @param keydir: the keydir to list the keys for
+        @returns: KeyListing instance
+        '''
+        path = pjoin(self.basedir, keydir)
+        listing = read_listing(path, self.logger)
+        if listing is not None:
+            self.logger.debug("LIB: list_keydir(); cached listing of %s"
+                % keydir)
+            return listing
+        stamp = keyring_stamp(path)
+        listing = keyring_listing(path, self.logger)
+        if listing is None:
+            result = self.list_keys(keydir, colons=True)
+            if not result:
+                return KeyListing()
+            listing = KeyListing(result.status.data)
+            if result.returncode:
+                return listing
+        write_listing(path, listing, stamp, self.logger)
+        return listing
+
+
     def check_keys(self, keydir, keyid, result=None):
         '''Check specified or all keys based on the seed type
 
         @param keydir: the keydir to list the keys for
         @param keyid: the keyid to check
-        @param result: optional pyGPG.output.GPGResult object
+        @param result: optional KeyListing of the keydir or
+                       pyGPG.output.GPGResult object
         @returns: GKEY_CHECK instance
         '''
-        if not result:
-            result = self.list_keys(keydir, fingerprint=keyid, colons=True)
+        if result is None:
+            result = self.list_keydir(keydir)
         checker = KeyChecks(self.logger, qualified_id_check=True)
         return checker.validity_checks(keydir, keyid, result)
 
@@ -294,11 +481,12 @@ class GkeysGPG(GPG):
 
         @param keydir: the keydir to list the keys for
         @param keyid: the keyid to check
-        @param result: optional pyGPG.output.GPGResult object
+        @param result: optional KeyListing of the keydir or
+                       pyGPG.output.GPGResult object
         @returns: SpecCheck instance
         '''
-        if not result:
-            result = self.list_keys(keydir, fingerprint=keyid, colons=True)
+        if result is None:
+            result = self.list_keydir(keydir)
         checker = KeyChecks(self.logger, qualified_id_check=True)
         specchecks = checker.spec_check(keydir, keyid, result)
         return specchecks
@@ -327,7 +515,7 @@ class GkeysGPG(GPG):
         '''
         self.set_keydir(gkey.keydir, 'verify', fingerprint=False, reset=True)
         self.logger.debug("** Calling runGPG with Running 'gpg %s --verify %s'"
-                % (' '.join(self.config['tasks']['verify']), filepath))
+                % (' '.join(self.task_options('verify')), filepath))
         results = self.runGPG(task='verify', inputfile=filepath, inputtxt=text)
         self._log_result('verification', gkey, results)
         return results
@@ -343,12 +531,12 @@ class GkeysGPG(GPG):
         if signature:
             self.set_keydir(gkey.keydir, 'verify', reset=True)
             self.logger.debug("** Calling runGPG with Running 'gpg %s --verify %s and %s'"
-                    % (' '.join(self.config['tasks']['verify']), signature, filepath))
+                    % (' '.join(self.task_options('verify')), signature, filepath))
             results = self.runGPG(task='verify', inputfile=[signature,filepath])
         else:
             self.set_keydir(gkey.keydir, 'decrypt', reset=True)
             self.logger.debug("** Calling runGPG with Running 'gpg %s --decrypt %s'"
-                    % (' '.join(self.config['tasks']['decrypt']), filepath))
+                    % (' '.join(self.task_options('decrypt')), filepath))
             results = self.runGPG(task='decrypt', inputfile=filepath)
         self._log_result('verification', gkey, results)
         return results
@@ -371,7 +559,7 @@ class GkeysGPG(GPG):
         '''
         self.set_keydir(gkey.keydir, mode, reset=True)
         self.logger.debug("** Calling runGPG with Running 'gpg %s --%s %s %s'"
-                % (' '.join(self.config['tasks'][mode]), mode, fingerprint, filepath))
+                % (' '.join(self.task_options(mode)), mode, fingerprint, filepath))
         results = self.runGPG(task=mode, inputfile=filepath)
         self._log_result('signing', gkey, results)
         return results
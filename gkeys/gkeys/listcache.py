@@ -0,0 +1,151 @@
+#
+#-*- coding:utf-8 -*-
+
+"""
+    Gentoo-keys - listcache.py
+
+    Persistent cache of the parsed colon listing of a keydir
+
+    The cache file is stored in the keydir and holds the listing records
+    along with the inode, size and mtime of the keyring and trustdb files
+    they were listed from.  It is only used while those still match and
+    until one of the listed keys expires, and is removed by the gpg
+    operations writing the keyring.
+
+    @copyright: 2015 by Brian Dolbec <dol-sen@gentoo.org>
+    @license: GNU GPL2, see COPYING for details.
+"""
+
+import calendar
+import json
+import os
+import time
+
+from collections import namedtuple
+
+from gkeys.checks import KeyListing
+from gkeys.fileops import atomic_write, file_stamp
+
+
+LISTING_NAME = '.gkeys-listing'
+LISTING_VERSION = 1
+
+# files of a keydir the listed keys and their validity are read from
+KEYRINGS = ['pubring.gpg', 'pubring.kbx', 'trustdb.gpg']
+
+# (record name, field names): namedtuple class of the loaded records
+_RECORD_TYPES = {}
+
+
+def listing_path(keydir):
+    '''Returns the path of the listing cache of a keydir'''
+    return os.path.join(keydir, LISTING_NAME)
+
+
+def keyring_stamp(keydir):
+    '''Returns the stamp used to detect changes of a keydir's keyrings
+
+    @param keydir: string, path of the key directory
+    @returns list of the keyring files [inode, size, mtime] values,
+        or None for a missing file
+    '''
+    return [file_stamp(os.path.join(keydir, name)) for name in KEYRINGS]
+
+
+def _expires(records, now):
+    '''Returns the first expiry time of the records after now, or None'''
+    first = None
+    for data in records:
+        value = getattr(data, 'expiredate', '') or ''
+        try:
+            if value.isdigit():
+                expires = int(value)
+            else:
+                expires = calendar.timegm(time.strptime(value[:10],
+                    '%Y-%m-%d'))
+        except (AttributeError, ValueError):
+            continue
+        if expires > now and (first is None or expires < first):
+            first = expires
+    return first
+
+
+def _record_type(name, fields):
+    key = (name, tuple(fields))
+    if key not in _RECORD_TYPES:
+        _RECORD_TYPES[key] = namedtuple(str(name), fields)
+    return _RECORD_TYPES[key]
+
+
+def _dump_record(data):
+    fields = getattr(data, '_fields', None)
+    if fields is None:
+        fields = sorted(vars(data))
+    return [data.name, list(fields), [getattr(data, f) for f in fields]]
+
+
+def read_listing(keydir, logger=None):
+    '''Returns the cached listing of a keydir
+
+    @param keydir: string, path of the key directory
+    @param logger: optional logger instance
+    @returns KeyListing instance, None if there is no valid cache
+    '''
+    path = listing_path(keydir)
+    try:
+        with open(path, 'r') as cachefile:
+            data = json.load(cachefile)
+    except (IOError, OSError, ValueError):
+        return None
+    if (not isinstance(data, dict) or
+            data.get('version') != LISTING_VERSION or
+            data.get('stamp') != keyring_stamp(keydir) or
+            (data.get('expires') and time.time() >= data['expires'])):
+        if logger:
+            logger.debug("ListCache: read_listing; stale cache %s" % path)
+        return None
+    try:
+        records = [_record_type(name, fields)(*values)
+            for name, fields, values in data['records']]
+    except (KeyError, TypeError, ValueError):
+        return None
+    return KeyListing(records)
+
+
+def write_listing(keydir, listing, stamp, logger=None):
+    '''Writes the listing cache of a keydir
+
+    @param keydir: string, path of the key directory
+    @param listing: KeyListing instance
+    @param stamp: keyring_stamp() value taken before listing the keys
+    @param logger: optional logger instance
+    @returns boolean
+    '''
+    if stamp != keyring_stamp(keydir):
+        # the keyring changed while it was listed
+        return False
+    path = listing_path(keydir)
+    records = listing.select()
+    data = {
+        'version': LISTING_VERSION,
+        'stamp': stamp,
+        # the validity of the listed keys changes when one expires
+        'expires': _expires(records, time.time()),
+        'records': [_dump_record(record) for record in records],
+        }
+    try:
+        atomic_write(path, json.dumps(data))
+    except (IOError, OSError, TypeError, ValueError) as err:
+        if logger:
+            logger.debug("ListCache: write_listing; failed to write %s: %s"
+                % (path, str(err)))
+        return False
+    return True
+
+
+def clear_listing(keydir):
+    '''Removes the listing cache of a keydir'''
+    try:
+        os.unlink(listing_path(keydir))
+    except OSError:
+        pass
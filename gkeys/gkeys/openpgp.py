@@ -0,0 +1,512 @@
+#
+#-*- coding:utf-8 -*-
+
+"""
+    Gentoo-keys - openpgp.py
+
+    Reads the public keys of a keyring file without running gpg
+
+    Parses the OpenPGP packets (RFC 4880) of a pubring.gpg keyring, or of
+    the OpenPGP blobs of a pubring.kbx keybox, into the same PUB, FPR,
+    UID and SUB records as a gpg --with-colons listing.  The key
+    algorithm, size, creation and expiry dates, capabilities, user ids
+    and revocations are taken from the packets and their self-signatures.
+
+    The signatures are not cryptographically verified and no trustdb is
+    read, so the validity of a key which is not revoked or expired is
+    reported as unknown ('-').  Verifying data still requires gpg.
+
+    @copyright: 2015 by Brian Dolbec <dol-sen@gentoo.org>
+    @license: GNU GPL2, see COPYING for details.
+"""
+
+import hashlib
+import os
+import struct
+import time
+
+from binascii import hexlify
+from collections import namedtuple
+
+from gkeys.checks import KeyListing
+
+
+KEYRINGS = ['pubring.gpg', 'pubring.kbx']
+
+# fields of the gpg colon listing records
+FIELDS = ['name', 'validity', 'keylength', 'pubkey_algo', 'long_keyid',
+    'creation_date', 'expiredate', 'certificate_serial_number', 'ownertrust',
+    'user_ID', 'signature_class', 'key_capabilities', 'issuer', 'flag',
+    'token', 'hash_algo', 'curve_name', 'fingerprint']
+
+PUB = namedtuple('PUB', FIELDS)
+SUB = namedtuple('SUB', FIELDS)
+UID = namedtuple('UID', FIELDS)
+FPR = namedtuple('FPR', FIELDS)
+
+EMPTY = dict([(field, '') for field in FIELDS])
+
+# packet tags
+TAG_SIGNATURE = 2
+TAG_SECRET_KEY = 5
+TAG_PUBLIC_KEY = 6
+TAG_SECRET_SUBKEY = 7
+TAG_USER_ID = 13
+TAG_PUBLIC_SUBKEY = 14
+TAG_USER_ATTRIBUTE = 17
+
+# signature types
+SIG_CERTIFICATIONS = [0x10, 0x11, 0x12, 0x13]
+SIG_SUBKEY_BINDING = 0x18
+SIG_DIRECT_KEY = 0x1F
+SIG_KEY_REVOCATION = 0x20
+SIG_SUBKEY_REVOCATION = 0x28
+SIG_CERT_REVOCATION = 0x30
+
+# signature subpacket types
+SUB_CREATED = 2
+SUB_SIG_EXPIRES = 3
+SUB_KEY_EXPIRES = 9
+SUB_ISSUER = 16
+SUB_PRIMARY_UID = 25
+SUB_KEY_FLAGS = 27
+SUB_ISSUER_FPR = 33
+
+# key flags: capability letter, in gpg's listing order
+KEY_FLAGS = [(0x0C, 'e'), (0x02, 's'), (0x01, 'c'), (0x20, 'a')]
+
+# capabilities of the keys without a key flags subpacket, by algorithm
+ALGORITHM_CAPS = {
+    1: 'esca', 2: 'e', 3: 'sc', 16: 'e', 17: 'sca', 18: 'e', 19: 'sca',
+    20: 'e', 22: 'sca',
+}
+
+# elliptic curve OIDs: (name, bits)
+CURVES = {
+    b'\x2a\x86\x48\xce\x3d\x03\x01\x07': ('nistp256', 256),
+    b'\x2b\x81\x04\x00\x22': ('nistp384', 384),
+    b'\x2b\x81\x04\x00\x23': ('nistp521', 521),
+    b'\x2b\x24\x03\x03\x02\x08\x01\x01\x07': ('brainpoolP256r1', 256),
+    b'\x2b\x24\x03\x03\x02\x08\x01\x01\x0b': ('brainpoolP384r1', 384),
+    b'\x2b\x24\x03\x03\x02\x08\x01\x01\x0d': ('brainpoolP512r1', 512),
+    b'\x2b\x81\x04\x00\x0a': ('secp256k1', 256),
+    b'\x2b\x06\x01\x04\x01\xda\x47\x0f\x01': ('ed25519', 255),
+    b'\x2b\x06\x01\x04\x01\x97\x55\x01\x05\x01': ('cv25519', 255),
+    b'\x2b\x65\x71': ('ed448', 448),
+    b'\x2b\x65\x6f': ('cv448', 448),
+}
+
+KEYBOX_MAGIC = b'KBXf'
+KEYBOX_OPENPGP = 2
+
+
+class PacketError(ValueError):
+    '''Malformed OpenPGP data'''
+
+
+def _byte(data, offset):
+    return struct.unpack_from('>B', data, offset)[0]
+
+
+def _mpi(data, offset):
+    '''Returns the bit length, value bytes and end offset of an MPI'''
+    bits = struct.unpack_from('>H', data, offset)[0]
+    end = offset + 2 + (bits + 7) // 8
+    if end > len(data):
+        raise PacketError("truncated MPI")
+    return bits, data[offset + 2:end], end
+
+
+def packets(data):
+    '''Splits OpenPGP data into its packets
+
+    @param data: bytes
+    @returns list of (tag, body bytes) tuples
+    '''
+    found = []
+    offset = 0
+    size = len(data)
+    while offset < size:
+        ctb = _byte(data, offset)
+        offset += 1
+        if not ctb & 0x80:
+            raise PacketError("invalid packet header at %d" % (offset - 1))
+        if ctb & 0x40:
+            # new format packet
+            tag = ctb & 0x3f
+            body = b''
+            while True:
+                first = _byte(data, offset)
+                if first < 192:
+                    length, offset = first, offset + 1
+                elif first < 224:
+                    length = ((first - 192) << 8) + _byte(data, offset + 1) + 192
+                    offset += 2
+                elif first == 255:
+                    length = struct.unpack_from('>I', data, offset + 1)[0]
+                    offset += 5
+                else:
+                    # partial body length, more parts follow
+                    length, offset = 1 << (first & 0x1f), offset + 1
+                    body += data[offset:offset + length]
+                    offset += length
+                    continue
+                body += data[offset:offset + length]
+                offset += length
+                break
+        else:
+            # old format packet
+            tag = (ctb >> 2) & 0x0f
+            length_type = ctb & 0x03
+            if length_type == 3:
+                length = size - offset
+            else:
+                width = 1 << length_type
+                length = int(hexlify(data[offset:offset + width]), 16)
+                offset += width
+            body = data[offset:offset + length]
+            offset += length
+        if offset > size:
+            raise PacketError("truncated packet")
+        found.append((tag, body))
+    return found
+
+
+def keybox_keyblocks(data):
+    '''Returns the OpenPGP keyblocks of a keybox file
+
+    @param data: bytes of a pubring.kbx file
+    @returns list of bytes
+    '''
+    blocks = []
+    offset = 0
+    while offset + 6 <= len(data):
+        length, blob_type = struct.unpack_from('>IB', data, offset)
+        if length < 6 or offset + length > len(data):
+            raise PacketError("invalid keybox blob at %d" % offset)
+        if blob_type == KEYBOX_OPENPGP:
+            start, size = struct.unpack_from('>II', data, offset + 8)
+            if start + size > length:
+                raise PacketError("invalid keybox keyblock at %d" % offset)
+            blocks.append(data[offset + start:offset + start + size])
+        offset += length
+    return blocks
+
+
+class PublicKey(object):
+    '''Public key or subkey packet'''
+
+    def __init__(self, body):
+        self.version = _byte(body, 0)
+        self.created = struct.unpack_from('>I', body, 1)[0]
+        # v3 keys carry their validity period in days
+        self.expires_after = 0
+        self.curve = ''
+        if self.version in [2, 3]:
+            days = struct.unpack_from('>H', body, 5)[0]
+            self.expires_after = days * 86400
+            self.algo = _byte(body, 7)
+            self.bits, modulus, end = _mpi(body, 8)
+            exponent = _mpi(body, end)[1]
+            self.fingerprint = hashlib.md5(modulus + exponent).hexdigest()
+            self.keyid = hexlify(modulus[-8:]).decode('ascii')
+        elif self.version == 4:
+            self.algo = _byte(body, 5)
+            if self.algo in [18, 19, 22]:
+                oid = body[7:7 + _byte(body, 6)]
+                self.curve, self.bits = CURVES.get(oid, ('', 0))
+            else:
+                self.bits = _mpi(body, 6)[0]
+            self.fingerprint = hashlib.sha1(b'\x99' +
+                struct.pack('>H', len(body)) + body).hexdigest()
+            self.keyid = self.fingerprint[-16:]
+        else:
+            # newer key versions are left to gpg's own listing
+            raise PacketError("unsupported key version %d" % self.version)
+        self.fingerprint = self.fingerprint.upper()
+        self.keyid = self.keyid.upper()
+        self.signatures = []
+
+
+class Signature(object):
+    '''The listing relevant data of a signature packet'''
+
+    def __init__(self, body):
+        self.version = _byte(body, 0)
+        self.issuer = ''
+        self.issuer_fpr = ''
+        self.expires = 0
+        self.key_expires = None
+        self.flags = None
+        self.primary = False
+        if self.version in [2, 3]:
+            self.sigtype = _byte(body, 2)
+            self.created = struct.unpack_from('>I', body, 3)[0]
+            self.issuer = hexlify(body[7:15]).decode('ascii').upper()
+            return
+        if self.version not in [4, 5]:
+            raise PacketError("unsupported signature version %d"
+                % self.version)
+        self.sigtype = _byte(body, 1)
+        self.created = 0
+        hashed = struct.unpack_from('>H', body, 4)[0]
+        self._subpackets(body[6:6 + hashed], True)
+        unhashed = struct.unpack_from('>H', body, 6 + hashed)[0]
+        start = 8 + hashed
+        self._subpackets(body[start:start + unhashed], False)
+
+
+    def _subpackets(self, data, hashed):
+        offset = 0
+        while offset < len(data):
+            first = _byte(data, offset)
+            if first < 192:
+                length, offset = first, offset + 1
+            elif first < 255:
+                length = ((first - 192) << 8) + _byte(data, offset + 1) + 192
+                offset += 2
+            else:
+                length = struct.unpack_from('>I', data, offset + 1)[0]
+                offset += 5
+            if not length or offset + length > len(data):
+                raise PacketError("invalid signature subpacket")
+            kind = _byte(data, offset) & 0x7f
+            value = data[offset + 1:offset + length]
+            offset += length
+            if kind == SUB_ISSUER:
+                self.issuer = hexlify(value).decode('ascii').upper()
+            elif kind == SUB_ISSUER_FPR:
+                self.issuer_fpr = hexlify(value[1:]).decode('ascii').upper()
+            elif not hashed:
+                # only the issuer can be trusted out of the hashed area
+                continue
+            elif kind == SUB_CREATED:
+                self.created = struct.unpack('>I', value[:4])[0]
+            elif kind == SUB_SIG_EXPIRES:
+                self.expires = struct.unpack('>I', value[:4])[0]
+            elif kind == SUB_KEY_EXPIRES:
+                self.key_expires = struct.unpack('>I', value[:4])[0]
+            elif kind == SUB_KEY_FLAGS:
+                self.flags = _byte(value, 0) if value else 0
+            elif kind == SUB_PRIMARY_UID:
+                self.primary = bool(value and _byte(value, 0))
+
+
+    def by(self, key):
+        '''Returns True if the signature was issued by a key'''
+        if self.issuer_fpr:
+            return self.issuer_fpr == key.fingerprint
+        return bool(self.issuer) and self.issuer == key.keyid[-16:]
+
+
+class TransferableKey(object):
+    '''A primary key with its user ids and subkeys'''
+
+    def __init__(self, key):
+        self.key = key
+        # list of [user id, list of Signatures]
+        self.uids = []
+        self.subkeys = []
+
+
+def transferable_keys(data):
+    '''Groups the packets of OpenPGP data by primary key
+
+    @param data: bytes of a keyring or keyblock
+    @returns list of TransferableKey instances
+    '''
+    keys = []
+    current = None
+    target = None
+    for tag, body in packets(data):
+        if tag == TAG_PUBLIC_KEY:
+            current = TransferableKey(PublicKey(body))
+            keys.append(current)
+            target = current.key.signatures
+        elif current is None:
+            # secret keys and stray packets
+            continue
+        elif tag == TAG_USER_ID:
+            uid = [body.decode('utf-8', 'replace'), []]
+            current.uids.append(uid)
+            target = uid[1]
+        elif tag == TAG_PUBLIC_SUBKEY:
+            subkey = PublicKey(body)
+            current.subkeys.append(subkey)
+            target = subkey.signatures
+        elif tag == TAG_USER_ATTRIBUTE:
+            # photo ids are not listed, skip their signatures
+            target = []
+        elif tag in [TAG_SECRET_KEY, TAG_SECRET_SUBKEY]:
+            current = target = None
+        elif tag == TAG_SIGNATURE and target is not None:
+            try:
+                target.append(Signature(body))
+            except (PacketError, struct.error):
+                # like gpg, ignore the signatures it can not use
+                continue
+    return keys
+
+
+def _caps(flags, algo):
+    if flags is None:
+        return ALGORITHM_CAPS.get(algo, '')
+    return ''.join([cap for bit, cap in KEY_FLAGS if flags & bit])
+
+
+def _latest(signatures):
+    if not signatures:
+        return None
+    return sorted(signatures, key=lambda sig: sig.created)[-1]
+
+
+def _record(kind, **values):
+    fields = dict(EMPTY)
+    fields['name'] = kind.__name__
+    for field, value in values.items():
+        fields[field] = '' if value is None else '%s' % value
+    return kind(**fields)
+
+
+def _key_fields(key, validity, caps, expires):
+    return dict(validity=validity, keylength=key.bits, pubkey_algo=key.algo,
+        long_keyid=key.keyid[-16:], creation_date=key.created,
+        expiredate=expires or '', key_capabilities=caps,
+        curve_name=key.curve, fingerprint=key.fingerprint)
+
+
+def key_records(tkey, now=None):
+    '''Returns the colon listing records of a transferable key
+
+    @param tkey: TransferableKey instance
+    @param now: optional time to check the expiry dates against
+    @returns list of PUB, FPR, UID and SUB records
+    '''
+    if now is None:
+        now = time.time()
+    primary = tkey.key
+    own = [sig for sig in primary.signatures if sig.by(primary)]
+    revoked = any([sig.sigtype == SIG_KEY_REVOCATION for sig in own])
+    # the latest self certification of each user id
+    uids = []
+    for user_id, signatures in tkey.uids:
+        certs = [sig for sig in signatures if sig.by(primary) and
+            sig.sigtype in SIG_CERTIFICATIONS + [SIG_CERT_REVOCATION]]
+        uids.append((user_id, _latest(certs)))
+    selfsigs = [sig for user_id, sig in uids
+        if sig is not None and sig.sigtype != SIG_CERT_REVOCATION]
+    # the primary user id's self signature sets the key's properties
+    selfsig = _latest([sig for sig in selfsigs if sig.primary]) \
+        or _latest(selfsigs)
+    direct = _latest([sig for sig in own if sig.sigtype == SIG_DIRECT_KEY])
+    flags = key_expires = None
+    for sig in [direct, selfsig]:
+        if sig is not None:
+            if sig.flags is not None:
+                flags = sig.flags
+            if sig.key_expires is not None:
+                key_expires = sig.key_expires
+    if primary.expires_after:
+        key_expires = primary.expires_after
+    expires = primary.created + key_expires if key_expires else None
+    if revoked:
+        validity = 'r'
+    elif expires and expires <= now:
+        validity = 'e'
+    elif selfsig is None and direct is None:
+        validity = 'i'
+    else:
+        validity = '-'
+    caps = _caps(flags, primary.algo)
+    # a primary key can always certify
+    if 'c' not in caps:
+        caps = caps.replace('a', '') + 'c' + ('a' if 'a' in caps else '')
+    usable = set(caps) if validity == '-' else set()
+    subrecords = []
+    for subkey in tkey.subkeys:
+        bindings = [sig for sig in subkey.signatures if sig.by(primary)]
+        binding = _latest([sig for sig in bindings
+            if sig.sigtype == SIG_SUBKEY_BINDING])
+        sub_expires = None
+        if subkey.expires_after:
+            sub_expires = subkey.created + subkey.expires_after
+        elif binding is not None and binding.key_expires:
+            sub_expires = subkey.created + binding.key_expires
+        if any([sig.sigtype == SIG_SUBKEY_REVOCATION for sig in bindings]):
+            sub_validity = 'r'
+        elif sub_expires and sub_expires <= now:
+            sub_validity = 'e'
+        elif binding is None:
+            sub_validity = 'i'
+        else:
+            sub_validity = validity
+        sub_caps = _caps(binding.flags if binding is not None else None,
+            subkey.algo)
+        if sub_validity == '-' and validity == '-':
+            usable.update(sub_caps)
+        subrecords.append(_record(SUB, **_key_fields(subkey, sub_validity,
+            sub_caps, sub_expires)))
+        subrecords.append(_record(FPR, fingerprint=subkey.fingerprint,
+            user_ID=subkey.fingerprint))
+    caps += ''.join([cap.upper() for bit, cap in KEY_FLAGS if cap in usable])
+    records = [_record(PUB, **_key_fields(primary, validity, caps, expires)),
+        _record(FPR, fingerprint=primary.fingerprint,
+            user_ID=primary.fingerprint)]
+    # like gpg, list the primary user id first
+    uids.sort(key=lambda uid: uid[1] is not selfsig)
+    for user_id, sig in uids:
+        if sig is None:
+            continue
+        if sig.sigtype == SIG_CERT_REVOCATION:
+            records.append(_record(UID, validity='r', user_ID=user_id))
+            continue
+        records.append(_record(UID,
+            validity=validity if validity in ['r', 'e'] else '-',
+            creation_date=sig.created,
+            expiredate=(sig.created + sig.expires) if sig.expires else '',
+            user_ID=user_id))
+    return records + subrecords
+
+
+def read_keyring(path, now=None):
+    '''Returns the colon listing records of all the keys of a keyring
+
+    @param path: string, path of a pubring.gpg keyring or pubring.kbx
+        keybox file
+    @param now: optional time to check the expiry dates against
+    @returns list of the records
+    @raises PacketError, IOError or OSError
+    '''
+    with open(path, 'rb') as keyring:
+        data = keyring.read()
+    if data[8:12] == KEYBOX_MAGIC:
+        blocks = keybox_keyblocks(data)
+    else:
+        blocks = [data]
+    records = []
+    for block in blocks:
+        for tkey in transferable_keys(block):
+            records.extend(key_records(tkey, now))
+    return records
+
+
+def keyring_listing(keydir, logger=None):
+    '''Lists the keys of a keydir's keyring
+
+    @param keydir: string, path of the key directory
+    @param logger: optional logger instance
+    @returns KeyListing instance, None if the keyring can not be read
+    '''
+    for name in KEYRINGS:
+        path = os.path.join(keydir, name)
+        if not os.path.exists(path):
+            continue
+        try:
+            return KeyListing(read_keyring(path))
+        except (PacketError, IOError, OSError, struct.error,
+                IndexError) as err:
+            if logger:
+                logger.debug("OpenPGP: keyring_listing; can not read %s: %s"
+                    % (path, str(err)))
+            return None
+    return KeyListing()
@@ -0,0 +1,168 @@
+#
+#-*- coding:utf-8 -*-
+
+"""
+    Gentoo-keys - scheduler.py
+
+    Runs keyserver jobs concurrently while limiting the requests in
+    flight to each keyserver, retrying the transient failures with an
+    exponential backoff.
+
+    @copyright: 2015 by Brian Dolbec <dol-sen@gentoo.org>
+    @license: GNU GPL2, see COPYING for details.
+"""
+
+import random
+import re
+import threading
+import time
+
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+
+# retries of a job after a transient failure
+RETRIES = 3
+# seconds waited before the first retry, doubled for each next one
+BACKOFF = 2.0
+# maximum seconds waited before a retry
+MAX_BACKOFF = 60.0
+
+# gpg error output of keyserver failures which are worth a retry
+TRANSIENT_ERRORS = [
+    'keyserver communications error',
+    'keyserver receive failed',
+    'keyserver refresh failed',
+    'server indicated a failure',
+    'connection refused',
+    'connection timed out',
+    'try again',
+    'temporary failure',
+    'no route to host',
+    'network is unreachable',
+    'service unavailable',
+    'too many requests',
+]
+
+# the same for the http status codes and timeouts, matched as whole words
+# and in their http or keyserver context only, as gpg also prints key ids
+TRANSIENT_RE = re.compile(r'\b(?:(?:http |keyserver )?status(?: code)?'
+    r'|error|code):? (?:429|502|503|504)\b|\btimeout\b')
+
+
+Outcome = namedtuple('Outcome', ['item', 'result', 'failed', 'attempts',
+    'error'])
+
+
+def gpg_transient(result):
+    '''Returns True if a GPGResult failed because of a transient
+    keyserver problem'''
+    if not result.returncode:
+        return False
+    output = str(getattr(result, 'stderr_out', '') or '').lower()
+    for error in TRANSIENT_ERRORS:
+        if error in output:
+            return True
+    return TRANSIENT_RE.search(output) is not None
+
+
+def gpg_failed(result):
+    '''Returns True if a GPGResult failed'''
+    return bool(result.returncode)
+
+
+class KeyserverScheduler(object):
+    '''Runs jobs in a thread pool, at most per_server of them at once
+    against the same keyserver'''
+
+
+    def __init__(self, workers, per_server, logger, retries=RETRIES,
+            backoff=BACKOFF, transient=gpg_transient, failed=gpg_failed,
+            sleep=time.sleep):
+        '''
+        @param workers: int, number of worker threads
+        @param per_server: int, maximum jobs in flight per keyserver
+        @param retries: int, retries of a job after a transient failure
+        @param backoff: float, seconds before the first retry
+        @param transient: function telling if a job result is worth a retry
+        @param failed: function telling if a job result is a failure
+        @param sleep: function used to wait between the retries
+        '''
+        self.workers = max(1, workers)
+        self.per_server = max(1, per_server)
+        self.logger = logger
+        self.retries = retries
+        self.backoff = backoff
+        self.transient = transient
+        self.failed = failed
+        self.sleep = sleep
+        self._limits = {}
+        self._lock = threading.Lock()
+        self._done_lock = threading.Lock()
+
+
+    def run(self, func, items, server, done=None):
+        '''Runs func(item) for each of the items
+
+        @param func: function running the keyserver job of an item
+        @param items: list of the items
+        @param server: function returning the keyserver of an item
+        @param done: optional function called with the Outcome of each
+            item as soon as it is known, one call at a time
+        @returns list of Outcome instances, in the items order
+        '''
+        jobs = [(func, item, server(item), done) for item in items]
+        if self.workers < 2 or len(jobs) < 2:
+            return [self._run_job(job) for job in jobs]
+        pool = ThreadPool(min(self.workers, len(jobs)))
+        try:
+            return pool.map(self._run_job, jobs)
+        finally:
+            pool.close()
+
+
+    def _limit(self, server):
+        with self._lock:
+            if server not in self._limits:
+                self._limits[server] = threading.BoundedSemaphore(
+                    self.per_server)
+            return self._limits[server]
+
+
+    def _run_job(self, job):
+        func, item, server, done = job
+        outcome = self._attempts(func, item, server)
+        if done is not None:
+            with self._done_lock:
+                done(outcome)
+        return outcome
+
+
+    def _attempts(self, func, item, server):
+        limit = self._limit(server)
+        attempt = 0
+        while True:
+            attempt += 1
+            limit.acquire()
+            try:
+                result = func(item)
+                error = None
+            except Exception as err:
+                result = None
+                error = err
+            finally:
+                limit.release()
+            if error is not None:
+                self.logger.error("Scheduler: _run_job; %s failed: %s"
+                    % (str(item), str(error)))
+                return Outcome(item, None, True, attempt, error)
+            if not self.transient(result) or attempt > self.retries:
+                return Outcome(item, result, self.failed(result), attempt,
+                    None)
+            delay = min(MAX_BACKOFF, self.backoff * 2 ** (attempt - 1))
+            # spread out the retries of jobs which failed together
+            delay *= random.uniform(0.5, 1.0)
+            self.logger.info("Scheduler: _run_job; %s transient failure "
+                "on %s, retry %d in %.1f seconds"
+                % (str(item), server, attempt, delay))
+            self.sleep(delay)
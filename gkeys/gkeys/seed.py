@@ -19,10 +19,15 @@ with gentoo-keys specific convienience functions.
 '''
 
 import codecs
+import hashlib
+import io
 import json
 import os
+import re
 import sys
 
+from collections import namedtuple
+
 from snakeoil.demandload import demandload
 
 from gkeys.gkey import GKEY
@@ -30,7 +35,8 @@ from gkeys.gkey import GKEY
 demandload(
     "gkeys.log:logger",
     "gkeys.exception:UpdateDbError",
-    "gkeys.fileops:ensure_dirs",
+    "gkeys.fileops:atomic_write,ensure_dirs,file_stamp",
+    "gkeys.seedcache:read_cache,write_cache",
 )
 
 if sys.version_info[0] >= 3:
@@ -41,23 +47,244 @@ else:
         return unicode(text)
 
 
+# seed file format version.  Version 1 entries may be missing the uid and
+# keys fields, they are upgraded by the migrate action.  The version is told
+# from the entries, so the files stay readable by the older gkeys releases
+# which take every top level json key for a seed nick.
+SEED_VERSION = 2
+
+# sorted lists of the seed nicks which differ between two seed files
+SeedsDiff = namedtuple('SeedsDiff', ['added', 'removed', 'changed'])
+
+# GKEY fields (and derived properties) with an inverted index
+# of value -> set of seed nicks maintained by the Seeds class
+INDEXED_FIELDS = ['nick', 'name', 'keydir', 'fingerprint', 'keys', 'keyid', 'uid']
+
+# free text fields which also get a trigram index of their lowercased values
+TRIGRAM_FIELDS = ['name', 'nick', 'uid']
+
+# estimated cost of the Seeds.list() and SeedHandler.key_search() filters,
+# the cheapest, most selective ones run first and narrow the candidates
+# the rest are checked against: index lookups of the (nearly) unique key
+# ids, trigram narrowed scans, scans of all the distinct indexed values,
+# then full scans of the seeds for any other field
+QUERY_COSTS = {'fingerprint': 0, 'keys': 0, 'keyid': 0, 'uid': 1,
+    'nick': 2, 'name': 2, 'keydir': 3}
+QUERY_SCAN_COST = 4
+
+# Seeds.list() fields looked up directly in their index
+EXACT_QUERY_FIELDS = ['fingerprint', 'keys', 'keyid', 'uid']
+
+# regular expression characters which end a run of literal characters
+REGEX_SPECIAL = '.^$*+?{}[]()|\\'
+
+# journaled seed file mutations are appended to <seedfile>.journal,
+# which is folded back into the seed file once it has this many entries.
+# Its first line records the stamp of the seed file the mutations apply to,
+# the journal is discarded once that file gets replaced.
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_COMPACT_SIZE = 1000
+
+# characters read at a time by the streaming seed file parser
+SEED_CHUNK_SIZE = 64 * 1024
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _JsonStream(object):
+    '''Minimal buffered reader of consecutive json values from a file'''
+
+    def __init__(self, fileobj, chunk_size):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+
+
+    def _read(self):
+        data = self.fileobj.read(self.chunk_size)
+        if not data:
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+
+    def char(self):
+        '''Consumes and returns the next non whitespace character,
+        or an empty string at the end of the file'''
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                self.pos += 1
+                return self.buf[self.pos - 1]
+            if not self._read():
+                return ''
+
+
+    def value(self):
+        '''Consumes and returns the next complete json value'''
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buf, self.pos).end()
+            try:
+                obj, self.pos = self.decoder.raw_decode(self.buf, self.pos)
+                return obj
+            except ValueError:
+                # most likely a value split across the read chunks
+                if not self._read():
+                    raise
+
+
+def iter_seedfile(seedfile, chunk_size=SEED_CHUNK_SIZE):
+    '''Incrementally parses a json seed file of {nick: {GKEY fields}}
+
+    Only the entry being parsed and one read chunk are held in memory.
+
+    @param seedfile: file object opened for reading
+    @param chunk_size: int, number of characters to read at a time
+    @yields (nick, dict) tuples in the file order
+    '''
+    stream = _JsonStream(seedfile, chunk_size)
+    if stream.char() != '{':
+        raise ValueError("Seed file is not a json object: %s"
+            % getattr(seedfile, 'name', seedfile))
+    while True:
+        char = stream.char()
+        if char == '}':
+            return
+        if char != '"':
+            raise ValueError("Invalid seed file entry at character %d"
+                % stream.pos)
+        stream.pos -= 1
+        nick = stream.value()
+        if stream.char() != ':':
+            raise ValueError("Invalid seed file entry for: %s" % nick)
+        yield nick, stream.value()
+        char = stream.char()
+        if char == '}':
+            return
+        if char != ',':
+            raise ValueError("Invalid seed file entry after: %s" % nick)
+
+
+def _journal_snapshot(line):
+    '''Returns the seed file stamp of a journal header line, or None'''
+    try:
+        header = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(header, dict):
+        return None
+    return header.get('snapshot')
+
+
+def journal_current(filename):
+    '''Returns True if the journal of a seed file exists and was
+    written against the current seed file'''
+    try:
+        with open(filename + JOURNAL_SUFFIX, 'r') as journal:
+            line = journal.readline()
+    except IOError:
+        return False
+    return _journal_snapshot(line) == file_stamp(filename)
+
+
+def read_journal(filename, logger=None):
+    '''Reads the mutations journal of a seed file
+
+    A journal written against a seed file since replaced, by a fetch or
+    an update of the seed files, is ignored.
+
+    @param filename: string, path of the seed file
+    @param logger: optional logger instance
+    @returns list of the journal operation dicts in the order recorded
+    '''
+    ops = []
+    try:
+        with open(filename + JOURNAL_SUFFIX, 'r') as journal:
+            lines = journal.readlines()
+    except IOError:
+        return ops
+    if not lines or _journal_snapshot(lines[0]) != file_stamp(filename):
+        if logger:
+            logger.debug("Seed: read_journal; ignoring %s, written for a "
+                "replaced seed file" % (filename + JOURNAL_SUFFIX))
+        return ops
+    for lineno, line in enumerate(lines[1:], 1):
+        try:
+            ops.append(json.loads(line))
+        except ValueError:
+            # most likely the partial last line of an interrupted write
+            if logger:
+                logger.debug("Seed: read_journal; skipping invalid entry %d in %s"
+                    % (lineno + 1, filename + JOURNAL_SUFFIX))
+    return ops
+
+
+def journal_state(ops):
+    '''Returns a dict of nick: final GKEY instance, or None
+    if deleted, for the nicks changed by the journal operations'''
+    state = {}
+    for op in ops:
+        if op.get('op') == 'add':
+            state[op['nick']] = GKEY(**op['gkey'])
+        elif op.get('op') == 'delete':
+            state[op['nick']] = None
+    return state
+
+
+def _trigrams(text):
+    '''Returns the set of 3 character substrings of the text'''
+    return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+
 class Seeds(object):
     '''Handles all seed key file operations'''
 
 
-    def __init__(self, filepath=None, config=None, _logger=None):
+    def __init__(self, filepath=None, config=None, _logger=None, journal=None):
         '''Seeds class init function
 
         @param filepath: string of the file to load
+        @param journal: optional Boolean, save changes to an append-only
+            journal instead of rewriting the seed file, defaults to the
+            'seed-journal' config setting
         '''
         self.filename = filepath
         self.config = config
         self.logger = _logger or logger
         self.seeds = {}
-
-
-    def load(self, filename=None, trap_errors=True, refresh=False):
-        '''Load the seed file into memory'''
+        self._index = {}
+        self._folded = {}
+        self._trigrams = {}
+        self._patched = False
+        self._reset_index()
+        # True when the seeds in memory differ from the seed file
+        self.dirty = False
+        # True when a watcher saw the seed file change since it was loaded
+        self.stale = False
+        # format version of the loaded seed file, None if not known
+        self.version = None
+        if journal is None:
+            journal = self._journal_config()
+        self.journal = journal
+        # journal operations not yet saved, number of saved ones
+        self._journal_ops = []
+        self._journal_len = 0
+
+
+    def load(self, filename=None, trap_errors=True, refresh=False, stream=False,
+            cache=True):
+        '''Load the seed file into memory
+
+        @param filename: optional string of the file to load
+        @param trap_errors: Boolean, only log IOErrors at the debug level
+        @param refresh: Boolean, auto-update old format seed entries
+        @param stream: Boolean, parse and convert the entries one at a time
+            instead of loading the complete json data first
+        @param cache: Boolean, load from (and refresh) the compiled seed cache
+        '''
         if filename:
             self.filename = filename
         if not self.filename:
@@ -66,9 +293,36 @@ class Seeds(object):
         self.logger.debug("Seeds: load; Begin loading seed file %s" % self.filename)
         seedlines = None
         self.seeds = {}
+        self._reset_index()
+        self.dirty = False
+        self.stale = False
+        self._journal_ops = []
+        self._journal_len = 0
+        if cache and not stream:
+            entries = read_cache(self.filename, self.logger)
+            if entries is not None:
+                for nick, gkey in entries:
+                    self.seeds[nick] = gkey
+                    self._index_add(nick, gkey)
+                self._journal_len = self.apply_journal(
+                    read_journal(self.filename, self.logger))
+                # old format files are not cached
+                self.version = SEED_VERSION
+                self.logger.debug("Seed: load; Completed loading seed cache for %s"
+                    % self.filename)
+                return True
+        self._patched = False
         try:
-            with open(self.filename, "r+") as seedfile:
-                seedlines = json.load(seedfile)
+            if stream:
+                with io.open(self.filename, "r", encoding='utf-8') as seedfile:
+                    for nick, data in iter_seedfile(seedfile):
+                        self.seeds[nick] = self._make_gkey(data, refresh)
+                        self._index_add(nick, self.seeds[nick])
+            else:
+                with open(self.filename, "rb") as seedfile:
+                    content = seedfile.read()
+                    stat = os.fstat(seedfile.fileno())
+                seedlines = json.loads(content.decode('utf-8'))
         except IOError as err:
             self.logger.debug("Seed: load; IOError occurred while loading file")
             if trap_errors:
@@ -76,53 +330,172 @@ class Seeds(object):
             else:
                 self._error(err)
             return False
-        for seed in list(seedlines.items()):
-            # GKEY class change auto-update
-            if not 'uid' in list(seed[1]):
-                if not refresh:
-                    raise UpdateDbError(filename)
-                seed[1]['uid'] = []
-            if not 'keys' in list(seed[1]):
-                if not refresh:
-                    raise UpdateDbError(filename)
-                seed[1]['keys'] = seed[1]['fingerprint'][:]
-
+        for seed in list((seedlines or {}).items()):
             #try:
-            self.seeds[seed[0]] = GKEY(**seed[1])
+            self.seeds[seed[0]] = self._make_gkey(seed[1], refresh)
+            self._index_add(seed[0], self.seeds[seed[0]])
             #except Exception as err:
                 #self.logger.debug("Seed: load; Error splitting seed: %s" % seed)
                 #self.logger.debug("Seed: load; ...............parts: %s" % str(parts))
                 #self._error(err)
+        # don't cache in-memory auto-updates of an old format seed file
+        if cache and not stream and not self._patched:
+            write_cache(self.filename, list(self.seeds.items()), content, stat,
+                self.logger)
+        self._journal_len = self.apply_journal(
+            read_journal(self.filename, self.logger))
         self.logger.debug("Seed: load; Completed loading seed file %s" % self.filename)
+        self.version = 1 if self._patched else SEED_VERSION
+        self.dirty = self._patched
         return True
 
 
-    def save(self, filename=None):
-        '''Save the seeds to the file'''
-        if filename:
+    def _make_gkey(self, data, refresh):
+        '''Returns a GKEY instance for a seed file entry
+
+        @param data: dict of the seed entry's GKEY fields
+        @param refresh: Boolean, auto-update old format seed entries
+        '''
+        try:
+            return GKEY(**data)
+        except TypeError:
+            # a version 1 entry missing some of the GKEY fields
+            pass
+        # GKEY class change auto-update
+        if not 'uid' in list(data):
+            if not refresh:
+                raise UpdateDbError(self.filename)
+            data['uid'] = []
+            self._patched = True
+        if not 'keys' in list(data):
+            if not refresh:
+                raise UpdateDbError(self.filename)
+            data['keys'] = data['fingerprint'][:]
+            self._patched = True
+        return GKEY(**data)
+
+
+    def save(self, filename=None, force=False):
+        '''Save the seeds to the file
+
+        The file is only rewritten if the seeds changed since they were
+        loaded or last saved.  It is written to a temporary file which
+        then replaces the seed file, so readers never see a partial file.
+
+        @param filename: optional string of the file to save to
+        @param force: Boolean, write the file even if nothing changed
+        @returns boolean
+        '''
+        if filename and filename != self.filename:
             self.filename = filename
+            force = True
         if not self.filename:
             self.logger.debug("Seed: save; Not a valid filename: '%s'" % str(self.filename))
             return False
-        self.logger.debug("Seed: save; Begin saving seed file %s" % self.filename)
-        ensure_dirs(os.path.split(self.filename)[0],
+        if not (self.dirty or force) and os.path.exists(self.filename):
+            self.logger.debug("Seed: save; No changes to save for %s" % self.filename)
+            return True
+        dirname = os.path.dirname(self.filename)
+        ensure_dirs(dirname,
             mode=int(self.config.get_key('permissions', "directories"),0),
             fatal=True)
-        os.umask(int(self.config.get_key("permissions", "files"),0))
+        umask = int(self.config.get_key("permissions", "files"),0)
+        os.umask(umask)
+        # entries auto-updated from an old format file need a full write,
+        # a journal on top of it would leave it unreadable without refresh
+        if (self.journal and not force and os.path.exists(self.filename) and
+                self.version == SEED_VERSION and not self._patched and
+                self._journal_len + len(self._journal_ops) < JOURNAL_COMPACT_SIZE):
+            return self._save_journal()
+        self.logger.debug("Seed: save; Begin saving seed file %s" % self.filename)
+        try:
+            mode = os.stat(self.filename).st_mode & 0o7777
+        except OSError:
+            mode = 0o666 & ~umask
+        try:
+            atomic_write(self.filename, self._seeds2json(self.seeds) + "\n",
+                mode)
+            # the new seed file includes all of the journaled changes
+            if os.path.exists(self.filename + JOURNAL_SUFFIX):
+                os.unlink(self.filename + JOURNAL_SUFFIX)
+        except (IOError, OSError) as err:
+            self._error(err)
+            return False
+        self._journal_ops = []
+        self._journal_len = 0
+        self.version = SEED_VERSION
+        self._patched = False
+        self.dirty = False
+        return True
+
+
+    def compact(self):
+        '''Folds the journaled changes back into the seed file'''
+        return self.save(force=True)
+
+
+    def _save_journal(self):
+        '''Appends the unsaved operations to the seed file's journal'''
+        self.logger.debug("Seed: save; Journaling %d changes to seed file %s"
+            % (len(self._journal_ops), self.filename))
+        lines = [json.dumps(op, sort_keys=True) + "\n"
+            for op in self._journal_ops]
+        mode = 'a'
+        if not journal_current(self.filename):
+            # start a new journal for the current seed file
+            lines.insert(0, json.dumps(
+                {'snapshot': file_stamp(self.filename)}) + "\n")
+            mode = 'w'
+            self._journal_len = 0
         try:
-            with open(self.filename, 'w') as seedfile:
-                seedfile.write(self._seeds2json(self.seeds))
-                seedfile.write("\n")
+            with open(self.filename + JOURNAL_SUFFIX, mode) as journal:
+                journal.write("".join(lines))
         except IOError as err:
             self._error(err)
             return False
+        self._journal_len += len(self._journal_ops)
+        self._journal_ops = []
+        self.dirty = False
         return True
 
 
+    def apply_journal(self, ops):
+        '''Replays journal operations on the seeds in memory
+
+        @param ops: list of journal operation dicts
+        @returns int, the number of operations applied
+        '''
+        for dev, gkey in list(journal_state(ops).items()):
+            oldkey = self.seeds.pop(dev, None)
+            if oldkey is not None:
+                self._index_remove(dev, oldkey)
+            if gkey:
+                self.seeds[dev] = gkey
+                self._index_add(dev, gkey)
+        return len(ops)
+
+
+    def _journal_config(self):
+        if not self.config:
+            return False
+        value = self.config.get_key('seed-journal')
+        return str(value).lower() in ['1', 'true', 'yes', 'on']
+
+
     def add(self, dev, gkey):
         '''Add a new seed key to memory'''
         if isinstance(gkey, dict) or isinstance(gkey, GKEY):
+            if dev in self.seeds:
+                if self.seeds[dev] == gkey:
+                    return True
+                self._index_remove(dev, self.seeds[dev])
             self.seeds[dev] = gkey
+            self._index_add(dev, gkey)
+            self.dirty = True
+            if self.journal:
+                if isinstance(gkey, GKEY):
+                    gkey = dict(gkey._asdict())
+                self._journal_ops.append({'op': 'add', 'nick': dev, 'gkey': gkey})
             return True
         return False
 
@@ -138,9 +511,14 @@ class Seeds(object):
             elif isinstance(gkey, GKEY):
                 nick = gkey.nick
             try:
-                self.seeds.pop(nick, None)
+                oldkey = self.seeds.pop(nick, None)
             except ValueError:
                 return False
+            if oldkey is not None:
+                self._index_remove(nick, oldkey)
+                self.dirty = True
+                if self.journal:
+                    self._journal_ops.append({'op': 'delete', 'nick': nick})
             return True
 
 
@@ -150,40 +528,115 @@ class Seeds(object):
         @param kwargs: dict of GKEY._fields and values
         @returns list
         '''
+        return list(self.query(**kwargs))
+
+
+    def query(self, **kwargs):
+        '''Lazily yields the key or keys matching the kwargs argument or all
+
+        The filters are applied cheapest and most selective first,
+        see QUERY_COSTS.  The kwargs are not modified.
+
+        @param kwargs: dict of GKEY._fields and values
+        @returns generator of GKEY instances, in sorted order
+        '''
         if not kwargs or ('nick' in kwargs and kwargs['nick'] == '*'):
-            return sorted(self.seeds.values())
-        # proceed with the search
-        # discard any invalid keys
-        keys = kwargs
-        result = self.seeds
-        for key in keys:
-            if not kwargs[key]:
+            for gkey in sorted(self.seeds.values()):
+                yield gkey
+            return
+        candidates = None
+        residual = []
+        for key, value in self._plan(kwargs):
+            if key in EXACT_QUERY_FIELDS:
+                found = self._exact_query(key, value)
+            elif candidates is None:
+                if key in INDEXED_FIELDS:
+                    found = self._substring_search(key, value, exact=False)
+                else:
+                    found = set(dev for dev, gkey in list(self.seeds.items())
+                        if value.lower() in getattr(gkey, key).lower())
+            else:
+                # the candidates are already narrowed, check them directly
+                residual.append((key, value))
                 continue
-            if key in ['fingerprint', 'keys', 'keyid']:
-                kwargs[key] = [x.replace(' ', '').upper() for x in kwargs[key]]
-            if key in ['fingerprint', 'keys', 'uid']:
-                result = {dev: gkey for dev, gkey in list(result.items()) if kwargs[key][0] in getattr(gkey, key)}
-            elif key in ['keyid']:
-                searchids = [x.lstrip('0X') for x in kwargs[key]]
-                res = {}
-                for dev, gkey in list(result.items()):
-                    keyids = [x.lstrip("0x") for x in getattr(gkey, key)]
-                    for keyid in searchids:
-                        if keyid in keyids:
-                            res[dev] = gkey
-                            break
-                result = res
+            if candidates is None:
+                candidates = set(found)
             else:
-                result = {dev: gkey for dev, gkey in list(result.items())
-                    if kwargs[key].lower()
-                    in getattr(gkey, key).lower()
-                    }
-        return sorted(result.values())
+                candidates &= found
+            if not candidates:
+                return
+        if candidates is None:
+            candidates = self.seeds
+        for gkey in sorted([self.seeds[dev] for dev in candidates]):
+            if all(self.field_match(gkey, key, value) for key, value in residual):
+                yield gkey
+
+
+    @staticmethod
+    def query_cost(field, exact=False):
+        '''Returns the estimated cost of a search on a seed field'''
+        if field == 'nick' and exact:
+            return -1
+        return QUERY_COSTS.get(field, QUERY_SCAN_COST)
+
 
+    def _plan(self, kwargs):
+        '''Returns the normalized list() filters in the order to apply them
 
-    def regex_search(self, pattern):
-        '''Search for the keys matching the regular expression pattern'''
-        pass
+        @param kwargs: dict of GKEY._fields and values
+        @returns list of (field, value) tuples
+        '''
+        plan = []
+        for key in kwargs:
+            value = kwargs[key]
+            # discard any empty criteria
+            if not value:
+                continue
+            if key in ['fingerprint', 'keys', 'keyid']:
+                value = [x.replace(' ', '').upper() for x in value]
+            plan.append((self.query_cost(key), key, value))
+        plan.sort(key=lambda x: (x[0], x[1]))
+        self.logger.debug("Seed: _plan; query plan: %s"
+            % str([x[1] for x in plan]))
+        return [(key, value) for cost, key, value in plan]
+
+
+    def _exact_query(self, key, value):
+        '''Looks up the seed nicks with an exact fingerprint, keys,
+        keyid or uid match in the indexes'''
+        if key == 'keyid':
+            found = set()
+            for keyid in value:
+                # index keys are the '0x' prefixed 16 char long keyids
+                keyid = keyid.lstrip('0X').rjust(16, '0')
+                found |= self._index[key].get('0x' + keyid, set())
+            return found
+        return self._index[key].get(value[0], set())
+
+
+    def regex_search(self, pattern, fields=None, exact=False):
+        '''Search for the keys matching the regular expression pattern
+
+        @param pattern: string, regular expression to search for
+        @param fields: optional list of the TRIGRAM_FIELDS to search,
+            defaults to all of them
+        @param exact: Boolean, case sensitive matching
+        @returns list of matching GKEY instances
+        '''
+        flags = 0 if exact else re.IGNORECASE
+        regex = re.compile(decoder(pattern), flags)
+        literal = self._regex_literal(pattern)
+        found = set()
+        for field in (fields or TRIGRAM_FIELDS):
+            if field not in TRIGRAM_FIELDS:
+                self.logger.debug("Seed: regex_search; Not a searchable field: %s"
+                    % field)
+                continue
+            for folded in self._trigram_candidates(field, literal):
+                for val in self._folded[field][folded]:
+                    if regex.search(val):
+                        found |= self._index[field][val]
+        return self._ordered(found)
 
 
     def nick_search(self, nick):
@@ -206,23 +659,158 @@ class Seeds(object):
         @param exact: Boolean
         @returns GKEY instance or None
         '''
-        results = []
         if field == 'nick' and exact:
             return self.nick_search(value)
-        for nick in self.seeds:
-            seed = self.seeds[nick]
-            val = getattr(seed, field)
-            if isinstance(val, list) or isinstance(value, list):
-                if  self._list_search(value, val, exact):
-                    results.append(seed)
-            elif exact:
-                if decoder(value) in val:
-                    results.append(seed)
+        if field in ['fingerprint', 'keys', 'keyid', 'uid']:
+            found = set()
+            for find in (value if isinstance(value, list) else [value]):
+                found |= self._substring_search(field, find, exact)
+            return self._ordered(found)
+        elif field in INDEXED_FIELDS and not isinstance(value, list):
+            return self._ordered(self._substring_search(field, value, exact))
+        return [seed for seed in self.seeds.values()
+            if self.field_match(seed, field, value, exact)]
+
+
+    def field_match(self, seed, field, value, exact=False):
+        '''Checks a single seed against a field_search() criteria
+
+        @param seed: GKEY instance
+        @param field: string
+        @param value: string or list of strings
+        @param exact: Boolean
+        @returns Boolean
+        '''
+        if field == 'nick' and exact:
+            return seed.nick == value
+        val = getattr(seed, field)
+        if isinstance(val, list) or isinstance(value, list):
+            return self._list_search(value, val, exact)
+        elif exact:
+            return decoder(value) in val
+        return decoder(value).lower() in val.lower()
+
+
+    def _substring_search(self, field, value, exact):
+        '''Searches the distinct indexed values of a field
+
+        @param field: string, one of INDEXED_FIELDS
+        @param value: string to find within the field values
+        @param exact: Boolean, case sensitive matching
+        @returns set of the matching seed nicks
+        '''
+        found = set()
+        if field in TRIGRAM_FIELDS:
+            value = decoder(value)
+            lower = value.lower()
+            for folded in self._trigram_candidates(field, lower):
+                if lower not in folded:
+                    continue
+                for val in self._folded[field][folded]:
+                    if not exact or value in val:
+                        found |= self._index[field][val]
+        elif exact:
+            value = decoder(value)
+            for val, nicks in list(self._index[field].items()):
+                if value in val:
+                    found |= nicks
+        else:
+            value = decoder(value).lower()
+            for val, nicks in list(self._index[field].items()):
+                if value in val.lower():
+                    found |= nicks
+        return found
+
+
+    def _trigram_candidates(self, field, text):
+        '''Returns the lowercased field values which contain
+        all of the trigrams of the text
+
+        @param field: string, one of TRIGRAM_FIELDS
+        @param text: string, a lowercase literal the values must contain
+        @returns set or list of lowercased values
+        '''
+        trigrams = _trigrams(text)
+        if not trigrams:
+            return list(self._folded[field])
+        postings = sorted([self._trigrams[field].get(t, set()) for t in trigrams],
+            key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates &= posting
+        return candidates
+
+
+    @staticmethod
+    def _regex_literal(pattern):
+        '''Returns the longest run of literal characters which every
+        match of the pattern must contain (lowercased), or an empty string
+        if none can be determined'''
+        runs = []
+        run = ''
+        depth = 0
+        i = 0
+        while i < len(pattern):
+            char = pattern[i]
+            if char == '\\':
+                escaped = pattern[i + 1:i + 2]
+                if depth:
+                    pass
+                elif escaped and not escaped.isalnum():
+                    run += escaped
+                elif escaped and escaped in 'bBdDsSwWAZ':
+                    runs.append(run)
+                    run = ''
+                else:
+                    # numeric, hex or unicode escapes, don't guess
+                    return ''
+                i += 2
+                continue
+            if char == '[':
+                # skip over the character class
+                i += 1
+                if pattern[i:i + 1] == '^':
+                    i += 1
+                if pattern[i:i + 1] == ']':
+                    i += 1
+                while i < len(pattern) and pattern[i] != ']':
+                    i += 1 + (pattern[i] == '\\')
+                if i >= len(pattern):
+                    return ''
+                runs.append(run)
+                run = ''
+                i += 1
+                continue
+            if char in '*?{':
+                # the previous character was optional
+                run = run[:-1]
+                if char == '{':
+                    i = pattern.find('}', i)
+                    if i < 0:
+                        return ''
+            elif char == '(':
+                depth += 1
+            elif char == ')':
+                depth = max(0, depth - 1)
+            elif char == '|' and not depth:
+                return ''
+            if char in REGEX_SPECIAL or depth:
+                runs.append(run)
+                run = ''
             else:
-                if decoder(value).lower() in val.lower():
-                    results.append(seed)
+                run += char
+            i += 1
+        runs.append(run)
+        return max(runs, key=len).lower()
+
 
-        return results
+    def _ordered(self, nicks):
+        '''Returns the seeds for the nicks in the seeds load order'''
+        if len(nicks) < 2:
+            return [self.seeds[nick] for nick in nicks]
+        return [self.seeds[nick] for nick in self.seeds if nick in nicks]
 
 
     def _list_search(self, find, values, exact):
@@ -252,13 +840,121 @@ class Seeds(object):
             self.logger.exception("Seed: Error was: %s" % str(err))
 
 
+    def _reset_index(self):
+        self._index = dict((field, {}) for field in INDEXED_FIELDS)
+        self._folded = dict((field, {}) for field in TRIGRAM_FIELDS)
+        self._trigrams = dict((field, {}) for field in TRIGRAM_FIELDS)
+
+
+    @staticmethod
+    def _field_values(gkey, field):
+        '''Returns the list of values to index for a seed field'''
+        if isinstance(gkey, dict):
+            if field == 'keyid':
+                return ['0x' + x[-16:] for x in gkey.get('fingerprint') or []]
+            value = gkey.get(field)
+        else:
+            value = getattr(gkey, field)
+        if value is None:
+            return []
+        if isinstance(value, list):
+            return value
+        return [value]
+
+
+    def _index_add(self, dev, gkey):
+        for field in INDEXED_FIELDS:
+            index = self._index[field]
+            for value in self._field_values(gkey, field):
+                if value not in index:
+                    index[value] = set()
+                    if field in TRIGRAM_FIELDS:
+                        self._trigram_add(field, value)
+                index[value].add(dev)
+
+
+    def _index_remove(self, dev, gkey):
+        for field in INDEXED_FIELDS:
+            index = self._index[field]
+            for value in self._field_values(gkey, field):
+                nicks = index.get(value)
+                if nicks:
+                    nicks.discard(dev)
+                    if not nicks:
+                        del index[value]
+                        if field in TRIGRAM_FIELDS:
+                            self._trigram_remove(field, value)
+
+
+    def _trigram_add(self, field, value):
+        folded = value.lower()
+        if folded not in self._folded[field]:
+            self._folded[field][folded] = set()
+            for trigram in _trigrams(folded):
+                self._trigrams[field].setdefault(trigram, set()).add(folded)
+        self._folded[field][folded].add(value)
+
+
+    def _trigram_remove(self, field, value):
+        folded = value.lower()
+        values = self._folded[field].get(folded)
+        if values is None:
+            return
+        values.discard(value)
+        if values:
+            return
+        del self._folded[field][folded]
+        for trigram in _trigrams(folded):
+            posting = self._trigrams[field].get(trigram)
+            if posting:
+                posting.discard(folded)
+                if not posting:
+                    del self._trigrams[field][trigram]
+
+
+    def digests(self):
+        '''Hashes each of the seed entries
+
+        @returns dict of nick: sha1 digest of the entry's json data
+        '''
+        digests = {}
+        for dev, value in list(self.seeds.items()):
+            if isinstance(value, GKEY):
+                value = value._asdict()
+            digests[dev] = hashlib.sha1(
+                json.dumps(value, sort_keys=True).encode('utf-8')).digest()
+        return digests
+
+
+    def diff(self, previous):
+        '''Compares the seeds to a previous version of them
+
+        @param previous: Seeds instance or a dict returned by its digests()
+        @returns SeedsDiff of the added, removed and changed nicks
+        '''
+        if isinstance(previous, Seeds):
+            previous = previous.digests()
+        added = []
+        changed = []
+        for dev, digest in list(self.digests().items()):
+            old = previous.get(dev)
+            if old is None:
+                added.append(dev)
+            elif old != digest:
+                changed.append(dev)
+        removed = [dev for dev in previous if dev not in self.seeds]
+        return SeedsDiff(sorted(added), sorted(removed), sorted(changed))
+
+
     def _seeds2json(self, seeds):
         if not seeds:
             seeds = {}
+        data = {}
         for dev, value in list(seeds.items()):
             if isinstance(value, GKEY):
-                seeds[dev] = dict(value._asdict())
-        return json.dumps(seeds, sort_keys=True, indent=4)
+                value = dict(value._asdict())
+            data[dev] = value
+        return json.dumps(data, sort_keys=True, indent=4)
 
 
     def update(self, gkey):
@@ -267,6 +963,8 @@ class Seeds(object):
         @param gkey: GKEY instance
         '''
         oldkey = self.nick_search(gkey.nick)
+        if oldkey == gkey:
+            return
         if oldkey:
             self.delete(oldkey)
         self.add(gkey.nick, gkey)
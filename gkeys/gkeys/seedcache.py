@@ -0,0 +1,187 @@
+#
+#-*- coding:utf-8 -*-
+
+"""
+    Gentoo-keys - seedcache.py
+
+    Compiled binary cache of the json seed files
+
+    The cache file is stored next to the seed file it was compiled from
+    and is only used while that seed file's mtime, size and content hash
+    still match the values recorded in the cache header.
+
+    Layout:  header, a uint32 count of the list items for each list field
+    of each entry, then a utf-8 blob of all the strings joined by NUL
+    characters.  This lets the loader decode the whole cache with a single
+    struct.unpack and a single str.split() call.
+
+    @copyright: 2015 by Brian Dolbec <dol-sen@gentoo.org>
+    @license: GNU GPL2, see COPYING for details.
+"""
+
+import hashlib
+import os
+import struct
+import time
+
+from gkeys.fileops import atomic_write, mtime_ns
+from gkeys.gkey import GKEY
+
+
+CACHE_SUFFIX = '.cache'
+CACHE_MAGIC = b'GKSC'
+CACHE_VERSION = 1
+
+# magic, version, seed file mtime (ns), seed file size, cache build time (ns),
+# seed file sha1 digest, number of entries, length of the strings blob
+HEADER = struct.Struct('<4sHqQq20sIQ')
+
+# seed files modified this close to the cache build time always get
+# their content hash checked, the mtime may not have changed on a rewrite
+RACY_NS = 2 * 10**9
+
+SEPARATOR = u'\x00'
+NONE_STR = u'\x01'
+NONE_COUNT = 0xFFFFFFFF
+
+# GKEY fields stored in the strings blob, in order
+STR_FIELDS = [f for f in GKEY._fields if GKEY.field_types[f] is not list]
+LIST_FIELDS = [f for f in GKEY._fields if GKEY.field_types[f] is list]
+
+
+def cache_path(filename):
+    '''Returns the path of the cache file for a seed file'''
+    return filename + CACHE_SUFFIX
+
+
+def file_digest(content):
+    '''Returns the sha1 digest of the seed file content bytes'''
+    return hashlib.sha1(content).digest()
+
+
+def read_cache(filename, logger=None):
+    '''Loads the cached entries of a seed file if the cache is fresh
+
+    @param filename: string, path of the json seed file
+    @param logger: optional logger instance
+    @returns list of (nick, GKEY) tuples or None if there is no
+        usable cache for the seed file
+    '''
+    try:
+        stat = os.stat(filename)
+        with open(cache_path(filename), 'rb') as cachefile:
+            data = cachefile.read()
+    except (IOError, OSError):
+        return None
+    if len(data) < HEADER.size:
+        return None
+    (magic, version, mtime, size, built, digest, count,
+        blob_len) = HEADER.unpack_from(data, 0)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION or size != stat.st_size:
+        return None
+    hashed = mtime != mtime_ns(stat) or mtime >= built - RACY_NS
+    if hashed:
+        try:
+            with open(filename, 'rb') as seedfile:
+                content = seedfile.read()
+        except (IOError, OSError):
+            return None
+        if file_digest(content) != digest:
+            if logger:
+                logger.debug("SeedCache: read_cache; stale cache for %s" % filename)
+            return None
+    try:
+        entries = _decode(data, count, blob_len)
+    except (struct.error, UnicodeDecodeError, ValueError, IndexError) as err:
+        if logger:
+            logger.debug("SeedCache: read_cache; invalid cache for %s: %s"
+                % (filename, str(err)))
+        return None
+    if hashed and mtime_ns(stat) < int(time.time() * 10**9) - RACY_NS:
+        # content unchanged, record its mtime with a build time out of the
+        # racy window to skip the hash next time
+        write_cache(filename, entries, content, stat, logger)
+    return entries
+
+
+def write_cache(filename, entries, content, stat=None, logger=None):
+    '''Compiles the seed file entries into its cache file
+
+    Failures are not fatal, the seed file is simply loaded
+    from the json data next time.
+
+    @param filename: string, path of the json seed file
+    @param entries: list of (nick, GKEY or dict) tuples
+    @param content: bytes, the seed file content the entries were parsed from
+    @param stat: optional os.stat_result of the seed file taken when
+        the content was read
+    @param logger: optional logger instance
+    @returns boolean
+    '''
+    path = cache_path(filename)
+    try:
+        stat = stat or os.stat(filename)
+        if stat.st_size != len(content):
+            return False
+        atomic_write(path, _encode(entries, stat, file_digest(content)))
+    except (IOError, OSError, TypeError, ValueError, AttributeError) as err:
+        if logger:
+            logger.debug("SeedCache: write_cache; failed to write %s: %s"
+                % (path, str(err)))
+        return False
+    return True
+
+
+def _encode(entries, stat, digest):
+    strings = []
+    counts = []
+    for nick, gkey in entries:
+        if isinstance(gkey, dict):
+            gkey = GKEY(**gkey)
+        strings.append(nick)
+        for field in STR_FIELDS:
+            value = getattr(gkey, field)
+            strings.append(NONE_STR if value is None else value)
+        for field in LIST_FIELDS:
+            values = getattr(gkey, field)
+            if values is None:
+                counts.append(NONE_COUNT)
+            else:
+                counts.append(len(values))
+                strings.extend(values)
+    for value in strings:
+        if SEPARATOR in value:
+            raise ValueError("Unsupported NUL character in: %r" % value)
+    blob = SEPARATOR.join(strings).encode('utf-8')
+    header = HEADER.pack(CACHE_MAGIC, CACHE_VERSION, mtime_ns(stat),
+        stat.st_size, int(time.time() * 10**9), digest, len(entries), len(blob))
+    return header + struct.pack('<%dI' % len(counts), *counts) + blob
+
+
+def _decode(data, count, blob_len):
+    width = len(LIST_FIELDS)
+    offset = HEADER.size
+    counts = struct.unpack_from('<%dI' % (count * width), data, offset)
+    offset += 4 * count * width
+    blob = data[offset:offset + blob_len]
+    if len(blob) != blob_len:
+        raise ValueError("Truncated cache file")
+    strings = blob.decode('utf-8').split(SEPARATOR)
+    entries = []
+    pos = 0
+    for index in range(count):
+        nick = strings[pos]
+        values = {}
+        for field in STR_FIELDS:
+            pos += 1
+            value = strings[pos]
+            values[field] = None if value == NONE_STR else value
+        pos += 1
+        for field, length in zip(LIST_FIELDS, counts[index * width:(index + 1) * width]):
+            if length == NONE_COUNT:
+                values[field] = None
+            else:
+                values[field] = strings[pos:pos + length]
+                pos += length
+        entries.append((nick, GKEY(**values)))
+    return entries
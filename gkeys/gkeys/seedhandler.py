@@ -13,18 +13,41 @@
 
 import os
 import re
+import weakref
+
+from collections import OrderedDict
 
 from snakeoil.demandload import demandload
 
+from gkeys.exception import UpdateDbError
 from gkeys.gkey import GKEY
-from gkeys.seed import Seeds, decoder
+from gkeys.seed import Seeds, SeedsDiff, decoder
 
 demandload(
-    "json:load",
-    "gkeys.exception:UpdateDbError",
+    "json:loads",
+    "multiprocessing.pool:ThreadPool",
+    "gkeys.fetcher:Fetcher,validators_path",
     "gkeys.fileops:ensure_dirs",
+    "gkeys.catindex:category_stamp,index_record,keydir_stamp,read_index,record_entries,write_index",
+    "gkeys.keyidindex:keyid_index_path,write_keyid_index",
+    "gkeys.keymap:KEY_MAP",
+    "gkeys.seed:journal_state,read_journal",
+    "gkeys.seedcache:read_cache,write_cache",
+    "gkeys.watcher:new_watcher",
 )
 
+# maximum number of threads reading the installed keydirs of a category
+LOAD_WORKERS = 8
+
+# maximum number of seed files downloaded at once by fetch_seeds()
+FETCH_WORKERS = 4
+
+# number of load_category() results kept by a SeedHandler
+CATEGORY_CACHE_SIZE = 8
+
+# files of a keydir whose changes make its category stale
+KEYDIR_FILES = ['gkey.seeds', 'gkey.seeds.journal']
+
 
 class SeedHandler(object):
 
@@ -34,6 +57,15 @@ class SeedHandler(object):
         self.fingerprint_re = re.compile('[0-9A-Fa-f]{40}')
         self.finerprint_re2 = re.compile('[0-9A-Fa-f]{4}( [0-9A-Fa-f]{4}){9}')
         self.seeds = None
+        # seed file nick: SeedsDiff of the changes made by fetch_seeds()
+        self.changes = {}
+        # (category, nicks): (stamp, Seeds) of the recent load_category()
+        # results, least recently used first
+        self._loaded = OrderedDict()
+        # optional watcher of the keyring and seed file directories
+        self.watcher = None
+        # seed file path: list of weak references to the loaded Seeds
+        self._seedfiles = {}
 
 
     def new(self, args, checkgkey=False):
@@ -74,6 +106,9 @@ class SeedHandler(object):
     def load_seeds(self, seedfile=None, filepath=None, refresh=False):
         '''Load seed file
 
+        While watching, the Seeds last loaded from the file is returned
+        again until the watcher sees the file change or it is modified.
+
         @param seeds: string of the short name seed file
         @param seedfile: string filepath of the file to load
         @return Seeds class instance of the file loaded
@@ -89,7 +124,22 @@ class SeedHandler(object):
             self.logger.error("SeedHandler: load_seeds; No filepath to load")
         self.logger.debug("SeedHandler: load_seeds; seeds filepath to load: "
             "%s" % filepath)
-        seeds = Seeds(config=self.config, _logger=self.logger)
+        if self.watcher:
+            self.check_changes()
+            refs = [ref for ref in self._seedfiles.get(filepath, [])
+                if ref() is not None]
+            for ref in reversed(refs):
+                seeds = ref()
+                if seeds is not None and not (seeds.stale or seeds.dirty):
+                    self.logger.debug("SeedHandler: load_seeds; reusing the "
+                        "unchanged seeds of %s" % filepath)
+                    self.seeds = seeds
+                    return seeds
+            seeds = Seeds(config=self.config, _logger=self.logger)
+            self._seedfiles[filepath] = refs + [weakref.ref(seeds)]
+            self.watcher.add(os.path.dirname(filepath))
+        else:
+            seeds = Seeds(config=self.config, _logger=self.logger)
         seeds.load(filepath, refresh=refresh)
         self.seeds = seeds
         return seeds
@@ -97,63 +147,338 @@ class SeedHandler(object):
     def load_category(self, category, nicks=None, refresh=False):
         '''Loads the designated key directories
 
+        Unchanged keydirs are loaded from the category's installed keys
+        index, the others' gkey.seeds files are read by a pool of up to
+        LOAD_WORKERS threads.  They are merged in sorted nick order.
+        Loading only some nicks reads their gkey.seeds files directly,
+        without parsing the whole category's index.
+
+        The last CATEGORY_CACHE_SIZE results are reused for as long as
+        their category directory and gkey.seeds files are unchanged, so
+        the returned Seeds instance must not be modified.
+
         @param category: string
         @param nicks: list of string nick ids to load
         @return Seeds class object
         '''
+        catdir = self.category_dir(category)
+        key = (category, tuple(sorted(nicks)) if nicks else None)
+        if self.watcher:
+            self.check_changes()
+        if not refresh:
+            seeds = self._cached(key, catdir)
+            if seeds is not None:
+                self.logger.debug("SeedHandler: load_category; cached %s"
+                    % catdir)
+                self.seeds = seeds
+                return seeds
         seeds = Seeds(config=self.config, _logger=self.logger)
-        if category == 'sign':
-            catdir = self.config.get_key('sign-keydir')
-        else:
-            keyrings = self.config.get_key('keyring')
-            catdir = os.path.join(keyrings, category)
         self.logger.debug("SeedHandler: load_category; catdir = %s" % catdir)
         try:
+            keydirs = self._keydirs(catdir, nicks)
+            stamp = self._load_stamp(catdir, keydirs)
+            index = {} if nicks else read_index(catdir, self.logger)
+            jobs = [(category, catdir, keydir, refresh, index.get(keydir))
+                for keydir in keydirs]
+            if len(jobs) > 1:
+                pool = ThreadPool(min(LOAD_WORKERS, len(jobs)))
+                try:
+                    results = pool.map(self._load_keydir, jobs)
+                finally:
+                    pool.close()
+            else:
+                results = [self._load_keydir(job) for job in jobs]
+            changed = False
+            for keydir, (entries, record, error) in zip(keydirs, results):
+                if error is not None:
+                    raise error
+                for nick, gkey in entries:
+                    seeds.add(nick, gkey)
+                if record:
+                    index[keydir] = record
+                    changed = True
+                elif record is False and index.pop(keydir, None) is not None:
+                    changed = True
             if not nicks:
-                nicks = os.listdir(catdir)
-            for nick in nicks:
-                seed_path = os.path.join(catdir, nick)
-                if not os.path.isdir(seed_path):
-                    continue
-                gkey_path = os.path.join(seed_path, 'gkey.seeds')
+                for keydir in set(index).difference(keydirs):
+                    del index[keydir]
+                    changed = True
+            if changed and not nicks:
+                write_index(catdir, index, self.logger)
+            if not refresh:
+                # creating the index file changed the category directory
+                stamp[0] = category_stamp(catdir)[0]
+                self._loaded[key] = (stamp, keydirs, seeds)
+                while len(self._loaded) > CATEGORY_CACHE_SIZE:
+                    self._loaded.popitem(last=False)
+        except OSError as error:
+            self.logger.debug("SeedHandler: load_category; OSError for %s" % catdir)
+            self.logger.exception("Error was: %s" % str(error))
+        self.seeds = seeds
+        return seeds
+
+
+    def _cached(self, key, catdir):
+        '''Returns the cached Seeds of a load_category() call, or None
+        if there is none or the keydirs it was loaded from changed'''
+        entry = self._loaded.pop(key, None)
+        if entry is None:
+            return None
+        stamp, keydirs, seeds = entry
+        # a watcher drops the changed categories' entries itself
+        if not self.watcher and stamp != self._load_stamp(catdir, keydirs):
+            return None
+        self._loaded[key] = entry
+        return seeds
+
+
+    @staticmethod
+    def _load_stamp(catdir, keydirs):
+        '''Returns the stamps of a category directory and the keydirs
+        loaded from it, adding or removing a keydir changes the first'''
+        return [category_stamp(catdir)[0]] + [keydir_stamp(catdir, keydir)
+            for keydir in keydirs]
+
+
+    def watch(self, watcher=None):
+        '''Watches the installed keys and seed files for changes
+
+        Once watching, the cached categories are reused without checking
+        their files, only the changes reported by the watcher make them
+        stale.  Meant for long running processes.
+
+        @param watcher: optional InotifyWatcher or PollingWatcher instance,
+            defaults to the best one available
+        @returns the watcher
+        '''
+        if watcher is None:
+            watcher = new_watcher(self.logger)
+        self.watcher = watcher
+        for category, catdir in self._watched_categories():
+            watcher.add(catdir)
+            if os.path.isdir(catdir):
+                for keydir in self._keydirs(catdir):
+                    watcher.add(os.path.join(catdir, keydir))
+        for filepath in self._watched_seedfiles():
+            watcher.add(os.path.dirname(filepath))
+        return watcher
+
+
+    def check_changes(self):
+        '''Marks the data cached for the changed files as stale
+
+        Drops the cached categories and key maps of the changed keydirs,
+        and sets the stale flag of the loaded Seeds of changed seed files,
+        so load_seeds() loads them again.
+
+        @returns set of the changed paths reported by the watcher
+        '''
+        if not self.watcher:
+            return set()
+        changed = self.watcher.changes()
+        if not changed:
+            return changed
+        self.logger.debug("SeedHandler: check_changes; changed: %s"
+            % ', '.join(sorted(changed)))
+        for category, catdir in self._watched_categories():
+            prefix = catdir.rstrip(os.sep) + os.sep
+            stale = False
+            for path in changed:
+                if path == catdir:
+                    stale = True
+                elif path.startswith(prefix):
+                    parts = path[len(prefix):].split(os.sep)
+                    if len(parts) == 1 and not parts[0].startswith('.'):
+                        # an added, removed or replaced keydir
+                        stale = True
+                        if os.path.isdir(path):
+                            self.watcher.add(path)
+                    elif len(parts) == 2 and parts[1] in KEYDIR_FILES:
+                        stale = True
+            if stale:
+                self.invalidate(category)
+                KEY_MAP.invalidate(catdir)
+        for filepath in self._watched_seedfiles():
+            dirpath = os.path.dirname(filepath)
+            prefix = dirpath.rstrip(os.sep) + os.sep
+            # the directory alone is reported when it was replaced, other
+            # entries of it, like the seed caches, don't change the seeds
+            replaced = dirpath in changed and not [path for path in changed
+                if path.startswith(prefix)]
+            if (replaced or filepath in changed or
+                    filepath + '.journal' in changed):
+                for ref in self._seedfiles.pop(filepath, []):
+                    seeds = ref()
+                    if seeds is not None:
+                        seeds.stale = True
+        return changed
+
+
+    def _watched_categories(self):
+        '''Returns the list of the (category, catdir) tuples to watch'''
+        return [(category, self.category_dir(category))
+            for category in sorted(self.config.get_key('seeds') or {})]
+
+
+    def _watched_seedfiles(self):
+        '''Returns the list of the seed file paths to watch'''
+        seedfiles = set(self._seedfiles)
+        for category in self.config.get_key('seeds') or {}:
+            filepath = self.config.get_key('seeds', category)
+            if filepath:
+                seedfiles.add(filepath)
+        return sorted(seedfiles)
+
+
+    def invalidate(self, category=None):
+        '''Drops the cached load_category() results of a category,
+        or of all of them
+
+        Must be called by the actions which modify the installed keys.
+        '''
+        for key in list(self._loaded):
+            if category is None or key[0] == category:
+                del self._loaded[key]
+
+
+    def category_dir(self, category):
+        '''Returns the installed keys directory of a category'''
+        if category == 'sign':
+            return self.config.get_key('sign-keydir')
+        return os.path.join(self.config.get_key('keyring'), category)
+
+
+    def update_keyid_index(self, categories=None):
+        '''Regenerates the keyid index of the installed keys
+
+        @param categories: optional list of the categories to index,
+            defaults to all the configured seed categories
+        @returns boolean
+        '''
+        if categories is None:
+            categories = sorted(self.config.get_key('seeds'))
+        entries = []
+        for category in categories:
+            if not os.path.isdir(self.category_dir(category)):
+                continue
+            seeds = self.load_category(category)
+            for nick in sorted(seeds.seeds):
+                entries.append((category, seeds.seeds[nick]))
+        path = keyid_index_path(self.config.get_key('keyring'))
+        return write_keyid_index(path, entries, self.logger)
+
+
+    @staticmethod
+    def _keydirs(catdir, nicks=None):
+        '''Returns the sorted list of the key directories of a category
+
+        @param catdir: string, path of the category directory
+        @param nicks: optional list of the nicks to look for
+        '''
+        if nicks:
+            return sorted([nick for nick in nicks
+                if os.path.isdir(os.path.join(catdir, nick))])
+        if hasattr(os, 'scandir'):
+            # the directory entry types avoid a stat of each of them
+            return sorted([entry.name for entry in os.scandir(catdir)
+                if entry.is_dir()])
+        return sorted([nick for nick in os.listdir(catdir)
+            if os.path.isdir(os.path.join(catdir, nick))])
+
+
+    def _load_keydir(self, job):
+        '''Reads the gkey.seeds file of an installed key directory
+
+        Runs in the load_category() thread pool, errors are returned
+        for the caller to raise in the keydirs order.
+
+        @param job: tuple of the category, its directory, the keydir,
+            the refresh setting and the keydir's index record or None
+        @returns tuple of the sorted (nick, GKEY) entries list, the new
+            index record (None if the index is current, False if the
+            entries can not be indexed) and an exception instance or None
+        '''
+        category, catdir, keydir, refresh, record = job
+        gkey_path = os.path.join(catdir, keydir, 'gkey.seeds')
+        entries = []
+        try:
+            stamp = keydir_stamp(catdir, keydir)
+            if record and record.get('stamp') == stamp:
+                return record_entries(record), None, None
+            patched = False
+            cached = read_cache(gkey_path, self.logger)
+            if cached is not None:
+                entries = cached
+            else:
                 seed = None
                 try:
-                    with open(gkey_path, 'r') as fileseed:
-                        seed = load(fileseed)
+                    with open(gkey_path, 'rb') as fileseed:
+                        content = fileseed.read()
+                        stat = os.fstat(fileseed.fileno())
+                    seed = loads(content.decode('utf-8'))
                 except IOError as error:
                     self.logger.debug("SeedHandler: load_category; IOError loading seed file %s." % gkey_path)
                     self.logger.debug("Error was: %s" % str(error))
                 if seed:
                     for nick in sorted(seed):
                         key = seed[nick]
-                        # GKEY class change auto-update
+                        try:
+                            entries.append((nick, GKEY(**key)))
+                            continue
+                        except TypeError:
+                            pass
+                        # GKEY class change auto-update of old format files
                         if not 'uid' in list(key):
                             if not refresh:
                                 raise UpdateDbError(category)
                             key['uid'] = []
+                            patched = True
                         if not 'keys' in list(key):
                             if not refresh:
                                 raise UpdateDbError(category)
                             key['keys'] = key['fingerprint'][:]
-                        seeds.add(nick, GKEY(**key))
-        except OSError as error:
-            self.logger.debug("SeedHandler: load_category; OSError for %s" % catdir)
-            self.logger.exception("Error was: %s" % str(error))
-        self.seeds = seeds
-        return seeds
+                            patched = True
+                        entries.append((nick, GKEY(**key)))
+                    if not patched:
+                        write_cache(gkey_path, entries, content, stat, self.logger)
+            journaled = journal_state(read_journal(gkey_path, self.logger))
+            if journaled:
+                entries = dict(entries)
+                for nick, gkey in list(journaled.items()):
+                    if gkey:
+                        entries[nick] = gkey
+                    else:
+                        entries.pop(nick, None)
+                entries = sorted(entries.items())
+            if patched:
+                # don't index in-memory auto-updates of an old format seed file
+                return entries, False, None
+            return entries, index_record(catdir, keydir, entries, stamp), None
+        except Exception as error:
+            return entries, False, error
+
 
-    def fetch_seeds(self, seeds, args, verified_dl=None):
+    def fetch_seeds(self, seeds, args, verified_dl=None, fetcher=None):
         '''Fetch new seed files
 
-        @param seeds: list of seed nicks to download
+        The seed files and their signatures are downloaded concurrently,
+        by up to FETCH_WORKERS threads sharing the fetcher's connections,
+        then each of them is verified in turn.  The verification is
+        skipped when the server reports that neither the seed file nor
+        its signature changed since they were last verified.
+
+        @param seeds: seed nick or list of seed nicks to download
         @param verified_dl: Function pointer to the Actions.verify()
-                instance needed to do the download and verification
+                instance needed to do the verification
+        @param fetcher: optional Fetcher instance to download with
         '''
         http_check = re.compile(r'^(http|https)://')
+        if not isinstance(seeds, list):
+            seeds = [seeds]
         urls = []
         messages = []
         try:
-            for seed in [seeds]:
+            for seed in seeds:
                 seedurl = self.config.get_key('seedurls', seed)
                 seedpath = self.config.get_key('seeds', seed)
                 if seedurl and seedpath and http_check.match(seedurl):
@@ -163,22 +488,104 @@ class SeedHandler(object):
         except KeyError:
             pass
         succeeded = []
+        if not urls:
+            return (succeeded, messages)
         seedsdir = self.config.get_key('seedsdir')
         mode = int(self.config.get_key('permissions', 'directories'),0)
         ensure_dirs(seedsdir, mode=mode)
-        for (seed, url, filepath) in urls:
+        own_fetcher = fetcher is None
+        if own_fetcher:
+            fetcher = Fetcher(self.logger, validators_path(seedsdir))
+        jobs = [(fetcher, url, filepath) for (seed, url, filepath) in urls]
+        try:
+            if len(jobs) > 1:
+                pool = ThreadPool(min(FETCH_WORKERS, len(jobs)))
+                try:
+                    downloads = pool.map(self._fetch_seed, jobs)
+                finally:
+                    pool.close()
+            else:
+                downloads = [self._fetch_seed(job) for job in jobs]
+        finally:
+            if own_fetcher:
+                fetcher.close()
+        for (seed, url, filepath), download in zip(urls, downloads):
+            fetched, sig_url, sig_path, previous = download
+            messages_ = []
+            if not fetched:
+                messages_.append("File %s cannot be retrieved." % filepath)
+            if not os.path.exists(filepath):
+                succeeded.append(False)
+                messages.append(messages_)
+                continue
+            if (fetched and sig_url and fetcher.cache.verified(url, filepath)
+                    and fetcher.cache.verified(sig_url, sig_path)):
+                self.logger.debug("SeedHandler: fetch_seeds; %s is unchanged"
+                    % filepath)
+                self.changes[seed] = SeedsDiff([], [], [])
+                messages_.append("Seeds %s: unchanged, already verified" % seed)
+                succeeded.append(True)
+                messages.append(messages_)
+                continue
             verify_info = self.config.get_key('verify-seeds', seed).split()
             args.category = verify_info[0]
             args.nick = verify_info[1]
-            args.filename = url
-            args.signature = None
-            args.timestamp = True
-            args.destination = filepath
-            verified, messages_ = verified_dl(args)
+            args.filename = filepath
+            args.signature = sig_path
+            args.timestamp = False
+            args.destination = None
+            verified, verify_msgs = verified_dl(args)
+            messages_.extend(verify_msgs)
             succeeded.append(verified)
+            fetcher.set_verified([url, sig_url], [filepath, sig_path], verified)
+            if verified:
+                changes = self._seed_digests(filepath, previous)
+                self.changes[seed] = changes
+                messages_.append("Seeds %s: %d added, %d removed, %d changed"
+                    % (seed, len(changes.added), len(changes.removed),
+                    len(changes.changed)))
             messages.append(messages_)
         return (succeeded, messages)
 
+
+    def _fetch_seed(self, job):
+        '''Downloads a seed file and its signature
+
+        Runs in the fetch_seeds() thread pool.
+
+        @param job: tuple of the Fetcher instance, the seed file url
+            and the path to save it to
+        @returns tuple of the download success, the signature url and
+            path or None and the seed digests of the previous file
+        '''
+        fetcher, url, filepath = job
+        previous = self._seed_digests(filepath)
+        fetched, content, timestamp = fetcher.fetch_file(url, filepath,
+            filepath + ".timestamp", climit=60)
+        sig_url = sig_path = None
+        if fetched:
+            sig_url, sig_path = fetcher.fetch_signature(url, filepath)
+        return (fetched, sig_url, sig_path, previous)
+
+
+    def _seed_digests(self, filepath, previous=None):
+        '''Returns the Seeds.digests() of a seed file, or the Seeds.diff()
+        from the previous digests
+
+        A missing or unreadable seed file has no entries, so a corrupt
+        file is replaced by the fetched one instead of aborting the fetch.
+        '''
+        seeds = Seeds(filepath, self.config, self.logger)
+        try:
+            seeds.load(refresh=True)
+        except (ValueError, UpdateDbError) as err:
+            self.logger.warning("SeedHandler: _seed_digests; unreadable seed "
+                "file %s: %s" % (filepath, str(err)))
+            seeds = Seeds(None, self.config, self.logger)
+        if previous is None:
+            return seeds.digests()
+        return seeds.diff(previous)
+
     def check_gkey(self, args):
         # assume it's good until an error is found
         is_good = True
@@ -227,33 +634,54 @@ class SeedHandler(object):
 
     def key_search(self, args, search_args):
         '''Performs a search for all listed args in the seeds'''
-        search_args.sort()
+        return list(self.iter_key_search(args, search_args))
+
+
+    def iter_key_search(self, args, search_args):
+        '''Lazily performs a search for all listed args in the seeds
+
+        When all the args must match, the cheapest, most selective search
+        runs first and the remaining args are only checked against its
+        results.
+
+        @param args: argparse.parse_args instance or dict of search values
+        @param search_args: list of the args to search on
+        @returns generator of GKEY instances, sorted by nick
+        '''
         self.logger.debug("SeedHandler.key_search() search_args: %s" % str(search_args))
         self.logger.debug("SeedHandler.key_search() search_args values: %s" % str(args))
-        results = []
-        found = {}
         if isinstance(args, dict):
             exact = args.get('exact', False)
             _all = args.get('all', False)
+            values = dict([(arg, args.get(arg, '')) for arg in search_args])
         else:
             exact = getattr(args, 'exact', False)
             _all = getattr(args, 'all', False)
-        for arg in search_args:
-            if isinstance(args, dict):
-                value = args.get(arg, '')
-            else:
-                value = getattr(args, arg)
-            seeds = self.seeds.field_search(arg, value, exact)
-            for seed in seeds:
-                if seed.nick in found:
-                    found[seed.nick]['args'].append(arg)
-                else:
-                    found[seed.nick] = {'args': [arg], 'seed': seed}
+            values = dict([(arg, getattr(args, arg)) for arg in search_args])
+        plan = sorted(set(search_args),
+            key=lambda arg: (self.seeds.query_cost(arg, exact), arg))
+        if not plan:
+            return
         if _all:
-            for possible in sorted(found):
-                if search_args == found[possible]['args']:
-                    results.append(found[possible]['seed'])
-        else:
+            found = self._field_search(plan[0], values[plan[0]], exact)
             for nick in sorted(found):
-                results.append(found[nick]['seed'])
-        return results
+                seed = found[nick]
+                if all(self.seeds.field_match(seed, arg, values[arg], exact)
+                        for arg in plan[1:]):
+                    yield seed
+            return
+        found = {}
+        for arg in plan:
+            found.update(self._field_search(arg, values[arg], exact))
+        for nick in sorted(found):
+            yield found[nick]
+
+
+    def _field_search(self, field, value, exact):
+        '''Returns a dict of nick: GKEY instance of the seeds
+        field_search() found'''
+        seeds = self.seeds.field_search(field, value, exact)
+        if isinstance(seeds, GKEY):
+            # exact nick searches return the seed itself
+            seeds = [seeds]
+        return dict([(seed.nick, seed) for seed in seeds])
@@ -0,0 +1,254 @@
+#
+#-*- coding:utf-8 -*-
+
+"""
+    Gentoo-keys - watcher.py
+
+    Watches directories for changes made by other processes
+
+    Uses Linux inotify when it is available, and otherwise polls the
+    directories' entries for inode, size and mtime changes.  Both only
+    report the changes since the previous changes() call, so a long
+    running process can check them before reusing its cached data.
+
+    @copyright: 2015 by Brian Dolbec <dol-sen@gentoo.org>
+    @license: GNU GPL2, see COPYING for details.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+
+from stat import S_ISDIR
+
+from gkeys.fileops import mtime_ns
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+    IN_ONLYDIR)
+
+EVENT = struct.Struct('iIII')
+
+
+def _stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if S_ISDIR(stat.st_mode):
+        # the entries of a sub-directory are not watched
+        return (stat.st_ino,)
+    return (stat.st_ino, stat.st_size, mtime_ns(stat))
+
+
+class PollingWatcher(object):
+    '''Detects the changes of the watched directories and of their
+    entries by comparing their stamps'''
+
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        # directory: dict of entry name: stamp, None for a missing directory
+        self._dirs = {}
+
+
+    def add(self, directory):
+        '''Starts watching a directory and its entries'''
+        if directory not in self._dirs:
+            self._dirs[directory] = self._scan(directory)
+
+
+    def remove(self, directory):
+        '''Stops watching a directory'''
+        self._dirs.pop(directory, None)
+
+
+    def watched(self):
+        '''Returns the list of the watched directories'''
+        return list(self._dirs)
+
+
+    def changes(self):
+        '''Returns the set of the paths changed since the last call
+
+        A changed entry of a watched directory is reported by its path,
+        a created, deleted or replaced directory by its own path.
+        '''
+        changed = set()
+        for directory in list(self._dirs):
+            previous = self._dirs[directory]
+            current = self._scan(directory)
+            if current == previous:
+                continue
+            self._dirs[directory] = current
+            if current is None or previous is None:
+                changed.add(directory)
+                continue
+            for name in set(previous).union(current):
+                if previous.get(name) == current.get(name):
+                    continue
+                if name:
+                    changed.add(os.path.join(directory, name))
+                else:
+                    changed.add(directory)
+        return changed
+
+
+    @staticmethod
+    def _scan(directory):
+        stamp = _stamp(directory)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return None
+        # the directory's inode tells if it was replaced
+        entries = {'': stamp}
+        for name in names:
+            entries[name] = _stamp(os.path.join(directory, name))
+        return entries
+
+
+    def close(self):
+        self._dirs = {}
+
+
+class InotifyWatcher(object):
+    '''Detects the changes of the watched directories and of their
+    entries with Linux inotify'''
+
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+            use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+            ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor: directory
+        self._wds = {}
+        # directory: watch descriptor, None if it could not be watched
+        self._dirs = {}
+
+
+    def add(self, directory):
+        '''Starts watching a directory and its entries'''
+        if self._dirs.get(directory) is not None:
+            return
+        path = directory
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = self._add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            # watched again once it is created
+            self._dirs[directory] = None
+            if self.logger:
+                self.logger.debug("InotifyWatcher: add; can not watch %s: %s"
+                    % (directory, os.strerror(ctypes.get_errno())))
+            return
+        self._wds[wd] = directory
+        self._dirs[directory] = wd
+
+
+    def remove(self, directory):
+        '''Stops watching a directory'''
+        wd = self._dirs.pop(directory, None)
+        if wd is not None:
+            self._wds.pop(wd, None)
+            self._rm_watch(self.fd, wd)
+
+
+    def watched(self):
+        '''Returns the list of the watched directories'''
+        return list(self._dirs)
+
+
+    def changes(self):
+        '''Returns the set of the paths changed since the last call
+
+        A changed entry of a watched directory is reported by its path,
+        a created, deleted or replaced directory by its own path.
+        '''
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as err:
+                if err.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    break
+                raise
+            if not data:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, everything may have changed
+                    changed.update(self._dirs)
+                    continue
+                directory = self._wds.get(wd)
+                if directory is None:
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    changed.add(directory)
+                    self._wds.pop(wd, None)
+                    self._dirs[directory] = None
+                elif name:
+                    changed.add(os.path.join(directory,
+                        name.decode(sys.getfilesystemencoding())))
+                else:
+                    changed.add(directory)
+        # retry the directories which were missing or got replaced
+        for directory in [d for d in self._dirs if self._dirs[d] is None]:
+            if os.path.isdir(directory):
+                self.add(directory)
+                if self._dirs[directory] is not None:
+                    changed.add(directory)
+        return changed
+
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+        self.fd = -1
+        self._wds = {}
+        self._dirs = {}
+
+
+def new_watcher(logger=None, polling=False):
+    '''Returns an InotifyWatcher, or a PollingWatcher if inotify is not
+    available or polling is requested'''
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(logger)
+        except (OSError, AttributeError) as err:
+            if logger:
+                logger.debug("Watcher: new_watcher; no inotify, polling: %s"
+                    % str(err))
+    return PollingWatcher(logger)
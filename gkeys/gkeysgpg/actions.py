@@ -114,10 +114,10 @@ class Actions(ActionBase):
 
         self.logger.debug(_unicode("ACTIONS: verify; catdir = %s") % catdir)
         if args.statusfd:
-            self.config.defaults['gpg_defaults'] = [
+            self.gpg.set_gpg_defaults([
                 '--display-charset', 'utf-8',
-                '--status-fd', args.statusfd]
-        self.config.defaults['gpg_defaults'].extend(["--trust-model", "always"])
+                '--status-fd', args.statusfd])
+        self.gpg.set_trust("always")
         self.logger.info("Verifying file...")
         results = self.gpg.verify_text(key, data.encode('utf-8'), args.verify)
         keyid = key.keyid[0]